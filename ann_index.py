@@ -0,0 +1,198 @@
+import os
+import json
+import shutil
+import time
+import numpy as np
+from preprocessing import FEATURE_PATH
+
+ANN_PATH = f'{FEATURE_PATH}/ann'
+_INDEX_ARRAYS = ('coarse', 'codebooks', 'offsets', 'ids', 'codes', 'norms', 'labels')
+
+
+def _squared_distances(X, centroids):
+    """N x K squared euclidean distances, computed as |x|^2 - 2 x.c + |c|^2 with one matrix product"""
+    d = (X ** 2).sum(axis=1)[:, None] - 2 * X @ centroids.T + (centroids ** 2).sum(axis=1)[None]
+    return np.maximum(d, 0)
+
+
+def _nearest(X, centroids, chunk_size=8192):
+    """Index of the closest centroid of every row, in chunks to bound the N x K distance matrix"""
+    return np.concatenate([_squared_distances(X[i:i + chunk_size], centroids).argmin(axis=1)
+                           for i in range(0, len(X), chunk_size)])
+
+
+def kmeans(X, k, n_iter=20, seed=12345):
+    """Lloyd's k-means on float32 rows with random initial rows, returning the k x D centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = X[rng.choice(len(X), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _nearest(X, centroids)
+        counts = np.bincount(assign, minlength=k)
+        order = np.argsort(assign, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        used = counts > 0
+        centroids[used] = np.add.reduceat(X[order], starts[used]) / counts[used, None]
+        if not used.all():
+            centroids[~used] = X[rng.choice(len(X), (~used).sum(), replace=False)]
+    return centroids
+
+
+def _split(X, n_subquantizers):
+    """View rows as n_subquantizers sub-vectors, zero padding the dimensions to a multiple of n_subquantizers"""
+    pad = -X.shape[1] % n_subquantizers
+    if pad:
+        X = np.pad(X, ((0, 0), (0, pad)))
+    return X.reshape(len(X), n_subquantizers, -1)
+
+
+def _encode(residuals, codebooks):
+    """Product quantization codes (N x M uint8) of residual vectors"""
+    sub = _split(residuals, len(codebooks))
+    return np.stack([_nearest(sub[:, j], codebooks[j]) for j in range(len(codebooks))], axis=1).astype(np.uint8)
+
+
+def build_index(data, labels=None, n_lists=None, n_subquantizers=16, n_iter=20, train_size=50000, seed=12345,
+                chunk_size=8192, verbose=True):
+    """Build an IVF-PQ index (dict of arrays) over the non-NaN rows of an N x D feature matrix"""
+    t0 = time.perf_counter()
+    rows = np.concatenate([start + np.flatnonzero(~np.isnan(np.asarray(data[start:start + chunk_size])).any(axis=1))
+                           for start in range(0, len(data), chunk_size)])
+    n_lists = n_lists or max(1, int(4 * np.sqrt(len(rows))))
+    rng = np.random.default_rng(seed)
+    train = np.asarray(data[np.sort(rng.choice(rows, min(train_size, len(rows)), replace=False))], dtype=np.float32)
+    coarse = kmeans(train, n_lists, n_iter, seed)
+    residuals = _split(train - coarse[_nearest(train, coarse)], n_subquantizers)
+    n_codes = min(256, len(train))
+    codebooks = np.stack([kmeans(np.ascontiguousarray(residuals[:, j]), n_codes, n_iter, seed + j)
+                          for j in range(n_subquantizers)])
+
+    lists, codes, norms = [], [], []
+    padded_coarse = _split(coarse, n_subquantizers).reshape(n_lists, -1)
+    for start in range(0, len(rows), chunk_size):
+        X = np.asarray(data[rows[start:start + chunk_size]], dtype=np.float32)
+        assign = _nearest(X, coarse)
+        chunk_codes = _encode(X - coarse[assign], codebooks)
+        lists.append(assign)
+        codes.append(chunk_codes)
+        # Squared norm of every row's reconstruction, so queries only need inner products with the codewords
+        residuals = codebooks[np.arange(n_subquantizers), chunk_codes].reshape(len(X), -1)
+        reconstruction = padded_coarse[assign] + residuals
+        norms.append((reconstruction ** 2).sum(axis=1))
+    lists, codes, norms = np.concatenate(lists), np.concatenate(codes), np.concatenate(norms)
+    # Rows are stored grouped by inverted list so every list is one contiguous slice
+    order = np.argsort(lists, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=n_lists))]).astype(np.int64)
+    ids = rows[order].astype(np.int64)
+    if labels is None:
+        labels = np.full(len(data), -1, dtype=np.int64)
+    index = {'coarse': coarse, 'codebooks': codebooks, 'offsets': offsets, 'ids': ids, 'codes': codes[order],
+             'norms': norms[order], 'labels': np.asarray(labels)[ids], 'n_dims': data.shape[1]}
+    if verbose:
+        print(f"Built IVF-PQ index over {len(ids)} rows ({n_lists} lists, {n_subquantizers} bytes per row) in "
+              f"{time.perf_counter() - t0:.1f}s")
+    return index
+
+
+def save_index(index, name):
+    """Atomically save the index under FEATURE_PATH/ann/{name}"""
+    path = f'{ANN_PATH}/{name}'
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for key in _INDEX_ARRAYS:
+        np.save(f'{tmp_path}/{key}.npy', index[key])
+    with open(f'{tmp_path}/meta.json', 'w') as f:
+        json.dump({'n_dims': int(index['n_dims'])}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_index(name):
+    """Load an index saved with save_index. The codes, ids and labels stay memory-mapped"""
+    path = f'{ANN_PATH}/{name}'
+    with open(f'{path}/meta.json') as f:
+        index = json.load(f)
+    for key in _INDEX_ARRAYS:
+        index[key] = np.load(f'{path}/{key}.npy', mmap_mode='r' if key in ('codes', 'ids', 'norms', 'labels') else None)
+    return index
+
+
+def search(index, queries, k=10, n_probe=8, exact=None, refine=4):
+    """Approximate top-k search returning Q x k (rows, squared distances, labels), optionally re-ranked"""
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    coarse, codebooks, offsets = index['coarse'], index['codebooks'], index['offsets']
+    n_subquantizers = len(codebooks)
+    n_probe = min(n_probe, len(coarse))
+    # |q - c - r|^2 = |q|^2 + |c + r|^2 - 2 q.c - 2 q.r, with q.r summed over the sub-vector codewords
+    query_norms = (queries ** 2).sum(axis=1)
+    query_coarse = queries @ coarse.T
+    probes = np.argsort(query_norms[:, None] - 2 * query_coarse + (coarse ** 2).sum(axis=1), axis=1)[:, :n_probe]
+    tables = np.einsum('qmd,mkd->qmk', _split(queries, n_subquantizers), codebooks)
+
+    # Candidates are tracked by their position in the list-ordered arrays, which maps to both row id and label
+    positions = np.full((len(queries), k), -1, dtype=np.int64)
+    distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+    n_keep = k * refine if exact is not None else k
+    sub_index = np.arange(n_subquantizers)
+    for i, lists in enumerate(probes):
+        sizes = offsets[lists + 1] - offsets[lists]
+        if not sizes.sum():
+            continue
+        candidates = np.concatenate([np.arange(offsets[l], offsets[l + 1]) for l in lists])
+        codes = np.asarray(index['codes'][candidates])
+        scores = (np.asarray(index['norms'][candidates]) - 2 * np.repeat(query_coarse[i, lists], sizes)
+                  - 2 * tables[i, sub_index, codes].sum(axis=1) + query_norms[i])
+        if len(scores) > n_keep:
+            best = np.argpartition(scores, n_keep)[:n_keep]
+            candidates, scores = candidates[best], scores[best]
+        if exact is not None:
+            scores = ((np.asarray(exact[index['ids'][candidates]], dtype=np.float32) - queries[i]) ** 2).sum(axis=1)
+        top = np.argsort(scores)[:k]
+        positions[i, :len(top)] = candidates[top]
+        distances[i, :len(top)] = scores[top]
+    found = positions >= 0
+    rows = np.where(found, np.asarray(index['ids'])[positions], -1)
+    labels = np.where(found, np.asarray(index['labels'])[positions], -1)
+    return rows, distances, labels
+
+
+def knn_predict(index, queries, k=10, n_probe=8, exact=None):
+    """kNN classification: the majority label among each query's k approximate nearest neighbors"""
+    _, _, labels = search(index, queries, k, n_probe, exact)
+    return np.array([np.bincount(row[row >= 0]).argmax() if (row >= 0).any() else -1 for row in labels])
+
+
+def brute_force_search(data, queries, k=10, chunk_size=8192):
+    """Exact top-k rows of data by squared euclidean distance, scanning data in chunks. NaN rows never match"""
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    best = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(data), chunk_size):
+        X = np.asarray(data[start:start + chunk_size], dtype=np.float32)
+        d = np.nan_to_num(_squared_distances(queries, X), nan=np.inf)
+        best = np.concatenate([best, d], axis=1)
+        best_rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(X)), d.shape)], axis=1)
+        keep = np.argsort(best, axis=1)[:, :k]
+        best, best_rows = np.take_along_axis(best, keep, axis=1), np.take_along_axis(best_rows, keep, axis=1)
+    return best_rows, best
+
+
+def evaluate_index(index, data, n_queries=500, k=10, n_probe=8, exact=False, seed=12345, verbose=True):
+    """Recall@k and queries/sec of the index against brute force search on rows of data"""
+    rng = np.random.default_rng(seed)
+    query_rows = np.sort(rng.choice(np.asarray(index['ids']), min(n_queries, len(index['ids'])), replace=False))
+    queries = np.asarray(data[query_rows], dtype=np.float32)
+    t0 = time.perf_counter()
+    rows = search(index, queries, k, n_probe, exact=data if exact else None)[0]
+    ann_seconds = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    true_rows = brute_force_search(data, queries, k)[0]
+    exact_seconds = time.perf_counter() - t0
+    recall = np.mean([len(np.intersect1d(a[a >= 0], b)) / k for a, b in zip(rows, true_rows)])
+    report = {'recall': float(recall), 'k': k, 'n_probe': n_probe, 'n_queries': len(queries),
+              'queries_per_sec': len(queries) / ann_seconds,
+              'brute_force_queries_per_sec': len(queries) / exact_seconds}
+    if verbose:
+        print(f"recall@{k} {recall:.3f} with n_probe={n_probe}: {report['queries_per_sec']:.0f} queries/sec vs "
+              f"{report['brute_force_queries_per_sec']:.0f} brute force")
+    return report
@@ -0,0 +1,79 @@
+import numpy as np
+import cv2
+from preprocessing import preprocess_image
+
+AUGMENT_SEED = 12345
+DEFAULT_AUGMENTATION = {'rotation': 15, 'scale': (0.9, 1.15), 'shift': 0.1, 'flip': 0.5, 'brightness': 0.1,
+                        'contrast': (0.8, 1.2), 'saturation': (0.8, 1.2)}
+# ITU-R BT.601 luma weights, the ones cv2.COLOR_RGB2GRAY uses
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def sample_params(sample_id, epoch=0, seed=AUGMENT_SEED, repeat=0, **settings):
+    """Random augmentation parameters of one sample seeded by (seed, epoch, sample_id, repeat)"""
+    settings = dict(DEFAULT_AUGMENTATION, **settings)
+    rng = np.random.default_rng([seed, epoch, int(sample_id)] + ([int(repeat)] if repeat else []))
+    return {'angle': rng.uniform(-settings['rotation'], settings['rotation']),
+            'scale': rng.uniform(*settings['scale']),
+            'shift': rng.uniform(-settings['shift'], settings['shift'], 2),
+            'flip': rng.random() < settings['flip'],
+            'brightness': rng.uniform(-settings['brightness'], settings['brightness']) * 255,
+            'contrast': rng.uniform(*settings['contrast']),
+            'saturation': rng.uniform(*settings['saturation'])}
+
+
+def affine_matrix(params, height, width):
+    """2 x 3 matrix of the flip, rotation, scaling and shift of one sample"""
+    center = ((width - 1) / 2, (height - 1) / 2)
+    matrix = np.vstack([cv2.getRotationMatrix2D(center, params['angle'], params['scale']), [0, 0, 1]])
+    if params['flip']:
+        matrix = matrix @ np.array([[-1, 0, width - 1], [0, 1, 0], [0, 0, 1]])
+    matrix[:2, 2] += params['shift'] * (width, height)
+    return matrix[:2]
+
+
+def color_matrix(params, mean_luma):
+    """3 x 4 matrix of the saturation, contrast and brightness jitter of one sample"""
+    saturation, contrast = params['saturation'], params['contrast']
+    matrix = saturation * np.eye(3, dtype=np.float32) + (1 - saturation) * _LUMA[None]
+    offset = (1 - contrast) * mean_luma + params['brightness']
+    return np.hstack([contrast * matrix, np.full((3, 1), offset, dtype=np.float32)])
+
+
+def augment_image(img, params, out=None):
+    """Apply one sample's augmentation to an H x W x 3 uint8 RGB image with one warp and one transform"""
+    height, width = img.shape[:2]
+    out = cv2.warpAffine(img, affine_matrix(params, height, width), (width, height), dst=out,
+                         flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT_101)
+    mean_luma = float(np.dot(cv2.mean(out)[:3], _LUMA))
+    return cv2.transform(out, color_matrix(params, mean_luma), dst=out)
+
+
+def augment_batch(imgs, sample_ids, epoch=0, seed=AUGMENT_SEED, out=None, repeats=None, **settings):
+    """Augment an N x H x W x 3 uint8 batch with per-sample parameters seeded by its rows and repeats"""
+    if out is None:
+        out = np.empty_like(imgs)
+    if repeats is None:
+        repeats = np.zeros(len(sample_ids), dtype=np.int64)
+    for i, (sample_id, repeat) in enumerate(zip(sample_ids, repeats)):
+        augment_image(imgs[i], sample_params(sample_id, epoch, seed, repeat, **settings), out=out[i])
+    return out
+
+
+def occurrence_index(order):
+    """How many times every entry of order already appeared before it, e.g. [3, 5, 3, 3] -> [0, 0, 1, 2]"""
+    order = np.asarray(order)
+    by_value = np.argsort(order, kind='stable')
+    sorted_order = order[by_value]
+    run_starts = np.flatnonzero(np.r_[True, sorted_order[1:] != sorted_order[:-1]])
+    run_lengths = np.diff(np.r_[run_starts, len(order)])
+    occurrences = np.empty(len(order), dtype=np.int64)
+    occurrences[by_value] = np.arange(len(order)) - np.repeat(run_starts, run_lengths)
+    return occurrences
+
+
+def _augment_chunk(start, items, epoch, seed, settings, equalize, fast):
+    """Worker entry point: preprocess and augment a chunk of (img_path, sample_id, repeat) items"""
+    img_paths, sample_ids, repeats = zip(*items)
+    imgs = np.stack([preprocess_image(p, equalize=equalize, fast=fast) for p in img_paths])
+    return start, augment_batch(imgs, sample_ids, epoch, seed, out=imgs, repeats=repeats, **settings)
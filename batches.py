@@ -0,0 +1,96 @@
+import numpy as np
+from preprocessing import iter_chunk_results, _preprocess_chunk
+from augment import _augment_chunk, occurrence_index, AUGMENT_SEED
+
+IMAGE_SHAPE = (256, 256, 3)
+
+
+def epoch_order(n_rows, seed=12345, epoch=0, shuffle=True):
+    """Row order of one epoch, only depending on the seed and the epoch number"""
+    if not shuffle:
+        return np.arange(n_rows)
+    return np.random.default_rng([seed, epoch]).permutation(n_rows)
+
+
+def class_indices(df):
+    """Row positions of every class as {label: sorted int64 array}, built with one argsort and no dataframe copy"""
+    labels = df['label'].to_numpy()
+    order = np.argsort(labels, kind='stable')
+    classes, starts = np.unique(labels[order], return_index=True)
+    return dict(zip(classes.tolist(), np.split(order, starts[1:])))
+
+
+def _class_stream(rows, start, count, key):
+    """Items start to start + count of an endless stream of seeded permutations of one class's rows"""
+    n = len(rows)
+    positions = np.arange(start, start + count)
+    passes = positions // n
+    out = np.empty(count, dtype=np.int64)
+    for j in np.unique(passes):
+        in_pass = passes == j
+        out[in_pass] = rows[np.random.default_rng(key + [int(j)]).permutation(n)[positions[in_pass] % n]]
+    return out
+
+
+def balanced_order(df, seed=12345, epoch=0, mode='oversample', weights=None, n_samples=None, indices=None):
+    """Class-balanced row order of one epoch by oversampling, undersampling or class weights"""
+    indices = indices if indices is not None else class_indices(df)
+    labels = list(indices)
+    sizes = np.array([len(indices[label]) for label in labels])
+    if mode == 'oversample':
+        counts = np.full(len(labels), sizes.max())
+    elif mode == 'undersample':
+        counts = np.full(len(labels), sizes.min())
+    elif mode == 'weighted':
+        p = np.array([(weights or {}).get(label, 1.0 if weights is None else 0.0) for label in labels], dtype=float)
+        draws = np.random.default_rng([seed, epoch]).choice(len(labels), n_samples or sizes.sum(), p=p / p.sum())
+        counts = np.bincount(draws, minlength=len(labels))
+    else:
+        raise ValueError(f"Unknown mode {mode!r}, expected 'oversample', 'undersample' or 'weighted'")
+
+    rng = np.random.default_rng([seed, epoch, 1])
+    rows, slots = [], []
+    for label, count in zip(labels, counts):
+        if mode == 'weighted':
+            rows.append(_class_stream(indices[label], 0, count, [seed, int(label), epoch]))
+        else:
+            rows.append(_class_stream(indices[label], epoch * count, count, [seed, int(label)]))
+        # Each class's rows are spread evenly over the epoch with a random offset inside their slot
+        slots.append((np.arange(count) + rng.random(count)) / max(count, 1))
+    return np.concatenate(rows)[np.argsort(np.concatenate(slots), kind='stable')]
+
+
+def iter_balanced_batches(df, batch_size=32, seed=12345, epoch=0, mode='oversample', weights=None, n_samples=None,
+                          indices=None, **kwargs):
+    """iter_batches over the balanced_order of the epoch. Other keyword arguments go to iter_batches"""
+    order = balanced_order(df, seed=seed, epoch=epoch, mode=mode, weights=weights, n_samples=n_samples,
+                           indices=indices)
+    return iter_batches(df, batch_size=batch_size, seed=seed, epoch=epoch, order=order, **kwargs)
+
+
+def iter_batches(df, batch_size=32, shuffle=True, seed=12345, epoch=0, drop_last=False, as_float=False,
+                 equalize=False, fast=True, n_workers=None, prefetch=4, reuse_buffers=False, order=None,
+                 augment=None, augment_seed=AUGMENT_SEED):
+    """Stream (images, labels) batches over the dataframe, preprocessed ahead in a process pool"""
+    if order is None:
+        order = epoch_order(len(df), seed=seed, epoch=epoch, shuffle=shuffle)
+    if drop_last:
+        order = order[:len(order) - len(order) % batch_size]
+    img_paths = df['img_path'].to_numpy()[order].tolist()
+    labels = df['label'].to_numpy()[order]
+
+    if augment:
+        settings = augment if isinstance(augment, dict) else {}
+        items = list(zip(img_paths, order.tolist(), occurrence_index(order).tolist()))
+        chunks = iter_chunk_results(_augment_chunk, items, epoch, augment_seed, settings, equalize, fast,
+                                    n_workers=n_workers, chunk_size=batch_size, max_pending=prefetch)
+    else:
+        chunks = iter_chunk_results(_preprocess_chunk, img_paths, equalize, fast, n_workers=n_workers,
+                                    chunk_size=batch_size, max_pending=prefetch)
+
+    buffer = np.empty((batch_size,) + IMAGE_SHAPE, dtype=np.float32) if as_float and reuse_buffers else None
+    for start, imgs in chunks:
+        if as_float:
+            out = buffer[:len(imgs)] if buffer is not None else None
+            imgs = np.multiply(imgs, np.float32(1 / 255), out=out, dtype=np.float32)
+        yield imgs, labels[start:start + len(imgs)]
@@ -0,0 +1,72 @@
+"""Measure how far the fast preprocessing path drifts from the reference skimage path.
+
+Compares preprocess_image(p, fast=True) (reduced JPEG decode + rescale_crop_image_fast) with preprocess_image(p) on a
+sample of the synthetic Animals-10 tree (see synthetic_dataset.py) plus a few large synthetic JPEGs that exercise the
+1/2, 1/4 and 1/8 reduced decodes, and reports the per-image mean and 99th percentile absolute pixel difference on the
+0-255 scale. preprocessing.FAST_MODE_TOLERANCE is the worst case of this measurement rounded up.
+
+    python benchmarks/fast_mode_accuracy.py --root /tmp/animals-synthetic --max-images 300
+"""
+import argparse
+import os
+import sys
+import cv2
+import numpy as np
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+from synthetic_dataset import generate_synthetic_dataset, _synthetic_image  # noqa: E402
+
+# (height, width) of the extra large JPEGs, from 2x to past 8x the standard size on the short side
+LARGE_SIZES = [(600, 800), (1200, 1600), (2048, 2048), (3000, 5000), (3840, 5760)]
+
+
+def _large_images(root, seed=12345):
+    """Write the LARGE_SIZES JPEGs under root/large once and return their paths"""
+    path = os.path.join(root, 'large')
+    os.makedirs(path, exist_ok=True)
+    paths = []
+    for i, (height, width) in enumerate(LARGE_SIZES):
+        img_path = os.path.join(path, f'large_{height}x{width}.jpg')
+        if not os.path.exists(img_path):
+            img = _synthetic_image(np.random.default_rng([seed, i]), height, width)
+            cv2.imwrite(img_path, img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        paths.append(img_path)
+    return paths
+
+
+def measure(img_path):
+    """(mean, 99th percentile) absolute difference between the fast and the reference preprocessing of one image"""
+    import preprocessing
+    diff = np.abs(preprocessing.preprocess_image(img_path, fast=True).astype(np.int16)
+                  - preprocessing.preprocess_image(img_path).astype(np.int16))
+    return float(diff.mean()), float(np.percentile(diff, 99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--root', default='/tmp/animals-synthetic', help='where the synthetic tree lives')
+    parser.add_argument('--n-images', type=int, default=2600, help='size of the synthetic tree')
+    parser.add_argument('--max-images', type=int, default=300, help='images sampled from the tree')
+    args = parser.parse_args()
+
+    generate_synthetic_dataset(args.root, args.n_images)
+    large_paths = _large_images(args.root)
+    os.chdir(os.path.join(args.root, 'project'))
+    import preprocessing
+    df = preprocessing.load_raw_dataframe()
+    df = df.sample(min(args.max_images, len(df)), random_state=12345)
+
+    tree = np.array([measure(p) for p in df['img_path']])
+    print(f"{'images':<24}{'n':>6}{'mean_abs p50':>14}{'mean_abs max':>14}{'p99_abs p50':>13}{'p99_abs max':>13}")
+    print(f"{'synthetic tree':<24}{len(tree):>6}{np.median(tree[:, 0]):>14.2f}{tree[:, 0].max():>14.2f}"
+          f"{np.median(tree[:, 1]):>13.1f}{tree[:, 1].max():>13.1f}")
+    for img_path in large_paths:
+        mean_abs, p99_abs = measure(img_path)
+        name = os.path.basename(img_path)[len('large_'):-len('.jpg')]
+        print(f"{name:<24}{1:>6}{mean_abs:>14.2f}{mean_abs:>14.2f}{p99_abs:>13.1f}{p99_abs:>13.1f}")
+    print(f"FAST_MODE_TOLERANCE: {preprocessing.FAST_MODE_TOLERANCE}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Measure the import time and memory footprint of the project modules.
+
+Each module is imported in a fresh interpreter so earlier imports cannot hide its cost. The report lists the wall
+time of the import, the peak RSS of the interpreter afterwards and which heavy dependencies the import pulled in.
+
+    python benchmarks/import_startup.py [--repeats 5] [--json results.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['', 'preprocessing', 'image_cache', 'features']
+HEAVY_MODULES = ['skimage', 'matplotlib', 'seaborn', 'tensorflow']
+
+CHILD_SCRIPT = '''
+import importlib, json, resource, sys, time
+t0 = time.perf_counter()
+if sys.argv[1]:
+    importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - t0
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss_kb //= 1024
+print(json.dumps({'seconds': elapsed, 'max_rss_mb': rss_kb / 1024,
+                  'heavy': sorted(m for m in sys.argv[2:] if m in sys.modules)}))
+'''
+
+
+def measure(module, repeats):
+    """Import module in repeats fresh interpreters and return the median time and the largest RSS"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_PATH, os.environ.get('PYTHONPATH')])))
+    runs = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', CHILD_SCRIPT, module] + HEAVY_MODULES, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    seconds = sorted(r['seconds'] for r in runs)[len(runs) // 2]
+    return {'module': module or '(interpreter)', 'seconds': seconds,
+            'max_rss_mb': max(r['max_rss_mb'] for r in runs), 'heavy': runs[-1]['heavy']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = [measure(m, args.repeats) for m in MODULES]
+    print(f"{'module':<16}{'import s':>10}{'max RSS MB':>12}  heavy dependencies loaded")
+    for r in results:
+        print(f"{r['module']:<16}{r['seconds']:>10.3f}{r['max_rss_mb']:>12.1f}  {', '.join(r['heavy']) or '-'}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Per-stage throughput, latency and memory benchmarks of the preprocessing pipeline.
+
+Every stage runs in a fresh interpreter against a synthetic Animals-10 shaped tree (see synthetic_dataset.py) and
+reports images/sec, p50/p99 latency per call and peak RSS. Results are written as JSON so runs on different commits can
+be compared with --compare.
+
+    python benchmarks/run_benchmarks.py --root /tmp/animals-synthetic --n-images 2600 --json HEAD.json
+    python benchmarks/run_benchmarks.py --root /tmp/animals-synthetic --json new.json --compare HEAD.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+from synthetic_dataset import generate_synthetic_dataset  # noqa: E402
+
+
+def _max_rss_mb():
+    """Peak resident set size of this process so far"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 1024
+
+
+def _paths(df):
+    return df['img_path'].to_list()
+
+
+def _decoded(df):
+    import cv2
+    return [cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2RGB) for p in df['img_path']]
+
+
+def _preprocessed(df):
+    import preprocessing
+    return [preprocessing.preprocess_image(p, fast=True) for p in df['img_path']]
+
+
+def _batches(imgs, batch_size=32):
+    import numpy as np
+    imgs = np.stack(imgs)
+    return [imgs[i:i + batch_size] for i in range(0, len(imgs), batch_size)]
+
+
+def _manifest_rows(df):
+    """Whole-manifest stages always process the full tree, not the sampled rows"""
+    import preprocessing
+    return len(preprocessing.load_raw_dataframe())
+
+
+def _warm_manifest_rows(df):
+    import preprocessing
+    preprocessing.load_manifest()
+    return _manifest_rows(df)
+
+
+def _clear_manifest():
+    import preprocessing
+    for f in (preprocessing.MANIFEST_FILE, preprocessing.MANIFEST_DIRS_FILE):
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def _stages():
+    """Stage name -> (setup(df) -> inputs, call(inputs) -> [(seconds, n_images), ...]). Only the call is timed"""
+    import preprocessing as pp
+
+    def per_item(func):
+        def call(items):
+            timings = []
+            for item in items:
+                t0 = time.perf_counter()
+                func(item)
+                timings.append((time.perf_counter() - t0, 1))
+            return timings
+        return call
+
+    def per_batch(func):
+        def call(batches):
+            timings = []
+            for batch in batches:
+                t0 = time.perf_counter()
+                func(batch)
+                timings.append((time.perf_counter() - t0, len(batch)))
+            return timings
+        return call
+
+    def whole_manifest(func, repeats=5, setup=lambda: None):
+        def call(n_rows):
+            timings = []
+            for _ in range(repeats):
+                setup()
+                t0 = time.perf_counter()
+                func()
+                timings.append((time.perf_counter() - t0, n_rows))
+            return timings
+        return call
+
+    return {
+        'load_raw_dataframe': (_manifest_rows, whole_manifest(pp.load_raw_dataframe)),
+        'load_manifest_cold': (_manifest_rows, whole_manifest(pp.load_manifest, setup=_clear_manifest)),
+        'load_manifest_warm': (_warm_manifest_rows, whole_manifest(pp.load_manifest)),
+        'read_image_header': (_paths, per_item(pp.read_image_header)),
+        'load_img_rgb': (_paths, per_item(pp.load_img_rgb)),
+        'load_img_rgb_reduced': (_paths, per_item(pp.load_img_rgb_reduced)),
+        'rescale_crop_image': (_decoded, per_item(pp.rescale_crop_image)),
+        'rescale_crop_image_fast': (_decoded, per_item(pp.rescale_crop_image_fast)),
+        'preprocess_image': (_paths, per_item(pp.preprocess_image)),
+        'preprocess_image_fast': (_paths, per_item(lambda p: pp.preprocess_image(p, fast=True))),
+        'normalize_rgb_histogram': (_preprocessed, per_item(pp.normalize_rgb_histogram)),
+        'normalize_rgb_histogram_batch': (lambda df: _batches(_preprocessed(df)),
+                                          per_batch(pp.normalize_rgb_histogram_batch)),
+        'rgb_to_grayscale': (_preprocessed, per_item(pp.rgb_to_grayscale)),
+        'rgb_to_grayscale_batch': (lambda df: _batches(_preprocessed(df)), per_batch(pp.rgb_to_grayscale_batch)),
+    }
+
+
+def run_stage(stage, project_path, max_images):
+    """Child process entry point: set up the inputs of one stage, time it and report its statistics"""
+    import numpy as np
+    os.chdir(project_path)
+    import preprocessing
+    df = preprocessing.load_raw_dataframe()
+    df = df.sample(min(max_images, len(df)), random_state=12345).reset_index(drop=True)
+    setup, call = _stages()[stage]
+    inputs = setup(df)
+    rss_before = _max_rss_mb()
+    timings = call(inputs)
+    seconds = np.array([t for t, _ in timings])
+    n_images = sum(n for _, n in timings)
+    return {'stage': stage, 'calls': len(timings), 'images': n_images,
+            'images_per_sec': n_images / max(seconds.sum(), 1e-12),
+            'p50_ms': float(np.percentile(seconds, 50) * 1000), 'p99_ms': float(np.percentile(seconds, 99) * 1000),
+            'setup_rss_mb': rss_before, 'peak_rss_mb': _max_rss_mb()}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--root', default='/tmp/animals-synthetic', help='where the synthetic tree lives')
+    parser.add_argument('--n-images', type=int, default=2600, help='size of the synthetic tree')
+    parser.add_argument('--max-images', type=int, default=300, help='images sampled for per-image stages')
+    parser.add_argument('--stages', nargs='*', help='subset of stages to run (default: all)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results file of a previous run to compare images/sec against')
+    args = parser.parse_args()
+
+    generate_synthetic_dataset(args.root, args.n_images)
+    project_path = os.path.join(args.root, 'project')
+    # Start from an empty feature directory so cached artifacts of earlier runs do not skew the timings
+    shutil.rmtree(os.path.join(args.root, 'archive', 'features'), ignore_errors=True)
+    stages = args.stages or list(_stages())
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for stage in stages:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append(pool.submit(run_stage, stage, project_path, args.max_images).result())
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {r['stage']: r for r in json.load(f)['results']}
+    print(f"{'stage':<32}{'images/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak RSS MB':>13}{'vs prev':>9}")
+    for r in results:
+        ratio = ''
+        if r['stage'] in previous:
+            ratio = f"{r['images_per_sec'] / previous[r['stage']]['images_per_sec']:.2f}x"
+        print(f"{r['stage']:<32}{r['images_per_sec']:>12.1f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+              f"{r['peak_rss_mb']:>13.1f}{ratio:>9}")
+    if args.json:
+        report = {'commit': _git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                  'n_images': args.n_images, 'max_images': args.max_images, 'results': results}
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Generate a deterministic synthetic image tree shaped like Animals-10.
+
+The tree mirrors the layout the project expects, <root>/archive/raw-img/<italian class>/<file>, so running code from
+<root>/project resolves DATA_PATH ('../archive/raw-img') to the synthetic data. Class proportions follow the real
+dataset and file names, formats and sizes mimic its two sources: Bing thumbnails (OIP-*.jpeg, 300px wide) and Pixabay
+downloads (*_640.jpg / *_640.png, 640px on the long side).
+
+    python benchmarks/synthetic_dataset.py /tmp/animals-synthetic --n-images 2600
+"""
+import argparse
+import json
+import os
+import shutil
+import cv2
+import numpy as np
+
+# Image counts per class in the real Animals-10 raw-img tree
+CLASS_COUNTS = {"cane": 4863, "cavallo": 2623, "elefante": 1446, "farfalla": 2112, "gallina": 3098, "gatto": 1668,
+                "mucca": 1866, "pecora": 1820, "ragno": 4821, "scoiattolo": 1862}
+PIXABAY_FRACTION = 0.35
+PNG_FRACTION = 0.03
+
+
+def _synthetic_image(rng, height, width):
+    """Photo-like image of smooth color fields, texture and noise"""
+    base = rng.integers(0, 256, (max(2, height // 48), max(2, width // 48), 3), dtype=np.uint8)
+    img = cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC).astype(np.int16)
+    texture = rng.integers(0, 256, (max(2, height // 4), max(2, width // 4), 3), dtype=np.uint8)
+    img += (cv2.resize(texture, (width, height), interpolation=cv2.INTER_LINEAR).astype(np.int16) - 128) // 4
+    img += rng.normal(0, 6, img.shape).astype(np.int16)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def _image_spec(rng, class_name, i):
+    """File name and (height, width) of one synthetic image"""
+    token = ''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'), 22))
+    if rng.random() < PIXABAY_FRACTION:
+        long_side, short_side = 640, int(rng.integers(360, 641))
+        height, width = (short_side, long_side) if rng.random() < 0.75 else (long_side, short_side)
+        ext = 'png' if rng.random() < PNG_FRACTION / PIXABAY_FRACTION else 'jpg'
+        return f'e{token.lower()}{i:04d}_640.{ext}', height, width
+    height = int(np.clip(rng.normal(220, 60), 120, 600))
+    return f'OIP-{token}{i:04d}.jpeg', height, 300
+
+
+def generate_synthetic_dataset(root, n_images=2600, seed=12345, verbose=True):
+    """Write a deterministic synthetic Animals-10 tree of about n_images images under root"""
+    data_path = os.path.join(root, 'archive', 'raw-img')
+    marker = os.path.join(root, 'synthetic.json')
+    params = {'n_images': n_images, 'seed': seed}
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == params:
+                return data_path
+        # A tree generated with other arguments is replaced rather than mixed with the new images
+        shutil.rmtree(data_path, ignore_errors=True)
+        os.remove(marker)
+    os.makedirs(os.path.join(root, 'project'), exist_ok=True)
+    total = sum(CLASS_COUNTS.values())
+    n_written = 0
+    for class_index, (class_name, count) in enumerate(CLASS_COUNTS.items()):
+        class_path = os.path.join(data_path, class_name)
+        os.makedirs(class_path, exist_ok=True)
+        rng = np.random.default_rng([seed, class_index])
+        for i in range(max(1, round(n_images * count / total))):
+            file_name, height, width = _image_spec(rng, class_name, i)
+            img = _synthetic_image(rng, height, width)
+            params_ext = [cv2.IMWRITE_JPEG_QUALITY, 90] if not file_name.endswith('.png') else []
+            cv2.imwrite(os.path.join(class_path, file_name), img, params_ext)
+            n_written += 1
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    if verbose:
+        print(f"Wrote {n_written} synthetic images to {data_path}")
+    return data_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root')
+    parser.add_argument('--n-images', type=int, default=2600)
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+    generate_synthetic_dataset(args.root, args.n_images, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import os
+import time
+import numpy as np
+from preprocessing import FEATURE_PATH
+from features import (open_feature_store, save_progress, load_features, load_quarantine, save_quarantine,
+                      manifest_hash, pending_chunk_starts)
+
+QUANTIZATIONS = ('float16', 'int8')
+
+
+def _pca_file(name):
+    return f'{FEATURE_PATH}/{name}_pca.npz'
+
+
+def _iter_finite_batches(data, batch_size, min_batch_size):
+    """Yield float64 batches of at least min_batch_size rows of data without NaN rows"""
+    pending, batch, n_rows = None, [], 0
+    for start in range(0, len(data), batch_size):
+        chunk = np.asarray(data[start:start + batch_size], dtype=np.float64)
+        batch.append(chunk[~np.isnan(chunk).any(axis=1)])
+        n_rows += len(batch[-1])
+        if n_rows >= batch_size:
+            if pending is not None:
+                yield pending
+            pending, batch, n_rows = np.concatenate(batch), [], 0
+    if pending is not None and n_rows < min_batch_size:
+        batch.insert(0, pending)
+        n_rows += len(pending)
+    elif pending is not None:
+        yield pending
+    if n_rows:
+        yield np.concatenate(batch)
+
+
+def _partial_fit(model, X):
+    """One incremental PCA update of model with the batch X"""
+    n_components = model['n_components']
+    n_seen, n_new = model['n_samples'], len(X)
+    n_total = n_seen + n_new
+    batch_mean = X.mean(axis=0)
+    if n_seen == 0:
+        stacked = X - batch_mean
+    else:
+        correction = np.sqrt(n_seen * n_new / n_total) * (model['mean'] - batch_mean)
+        stacked = np.vstack([model['singular_values'][:, None] * model['components'], X - batch_mean, correction])
+    _, S, Vt = np.linalg.svd(stacked, full_matrices=False)
+    # Fix the sign of every component so the same data always gives the same model
+    signs = np.sign(Vt[np.arange(len(Vt)), np.abs(Vt).argmax(axis=1)])
+    Vt *= signs[:, None]
+    model['mean'] = (n_seen * model['mean'] + n_new * batch_mean) / n_total if n_seen else batch_mean
+    model['components'] = Vt[:n_components]
+    model['singular_values'] = S[:n_components]
+    model['n_samples'] = n_total
+    model['sum_squares'] = model['sum_squares'] + (X ** 2).sum(axis=0)
+
+
+def fit_incremental_pca(data, n_components=128, batch_size=1024):
+    """Fit a PCA with n_components on the non-NaN rows of data in mini-batches"""
+    if not 0 < n_components <= data.shape[1]:
+        raise ValueError(f'n_components must be between 1 and the {data.shape[1]} feature dimensions, '
+                         f'got {n_components}')
+    batch_size = max(batch_size, n_components)
+    model = {'n_components': n_components, 'n_samples': 0, 'mean': 0.0, 'sum_squares': 0.0}
+    for X in _iter_finite_batches(data, batch_size, n_components):
+        _partial_fit(model, X)
+    n = model['n_samples']
+    if n < n_components:
+        raise ValueError(f'Cannot fit {n_components} components on {n} rows')
+    total_variance = (model['sum_squares'] - n * model['mean'] ** 2).sum() / (n - 1)
+    explained_variance = model['singular_values'] ** 2 / (n - 1)
+    return {'mean': model['mean'], 'components': model['components'], 'singular_values': model['singular_values'],
+            'explained_variance': explained_variance, 'explained_variance_ratio': explained_variance / total_variance}
+
+
+def project(pca, X):
+    """Project rows of features onto the PCA components as float32"""
+    mean = pca['mean'].astype(np.float32)
+    return (np.asarray(X, dtype=np.float32) - mean) @ pca['components'].T.astype(np.float32)
+
+
+def build_compact_features(source, n_components=128, quantization='int8', name=None, batch_size=1024,
+                           verbose=True):
+    """Store the PCA reduction of the feature matrix source as float16 or int8, returning its name"""
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f'quantization must be one of {QUANTIZATIONS}')
+    name = name or f'{source}_pca{n_components}_{quantization}'
+    data, source_meta = load_features(source)
+    quarantined = source_meta.pop('quarantined')
+    meta = {'feature': 'pca', 'source': source, 'source_meta': source_meta, 'n_components': n_components,
+            'quantization': quantization, 'manifest': source_meta['manifest']}
+    try:
+        stored = load_compact_features(name)[1]
+        if all(stored.get(key) == value for key, value in meta.items()):
+            return name
+    except (FileNotFoundError, ValueError):
+        pass
+
+    t0 = time.perf_counter()
+    pca = fit_incremental_pca(data, n_components, batch_size)
+    scales = np.ones(n_components, dtype=np.float32)
+    if quantization == 'int8':
+        # Symmetric per-dimension scales mapping the largest projected magnitude to 127
+        max_abs = np.zeros(n_components, dtype=np.float32)
+        for start in range(0, len(data), batch_size):
+            max_abs = np.fmax(max_abs, np.nanmax(np.abs(project(pca, data[start:start + batch_size])), axis=0))
+        scales = np.maximum(max_abs, np.finfo(np.float32).tiny) / 127
+    tmp_file = _pca_file(name)[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmp_file, scales=scales, **pca)
+    os.replace(tmp_file, _pca_file(name))
+
+    out, done = open_feature_store(name, meta, len(data), n_components, quantization)
+    for start in pending_chunk_starts(done, batch_size):
+        reduced = project(pca, data[start:start + batch_size])
+        if quantization == 'int8':
+            reduced = np.nan_to_num(np.clip(np.rint(reduced / scales), -127, 127)).astype(np.int8)
+        out[start:start + len(reduced)] = reduced
+        out.flush()
+        done[start:start + len(reduced)] = True
+        save_progress(name, done)
+    save_quarantine(name, {row: entry for row, entry in load_quarantine(source).items() if row in quarantined})
+    if verbose:
+        elapsed = time.perf_counter() - t0
+        retained = pca['explained_variance_ratio'].sum()
+        print(f"Compacted {source} {data.shape} {data.dtype} ({data.nbytes / 2 ** 20:.1f} MB) to {out.shape} "
+              f"{quantization} ({out.nbytes / 2 ** 20:.1f} MB) retaining {retained:.1%} of the variance in "
+              f"{elapsed:.1f}s")
+    del out
+    return name
+
+
+def load_compact_features(name):
+    """Return the read-only memory-mapped compact matrix, its metadata and its PCA model (with the int8 scales)"""
+    data, meta = load_features(name)
+    with np.load(_pca_file(name)) as f:
+        pca = dict(f)
+    return data, meta, pca
+
+
+def read_compact_features(name, df, rows=None):
+    """Return float32 features and labels of the manifest rows of a compact feature store"""
+    data, meta, pca = load_compact_features(name)
+    if manifest_hash(df) != meta['manifest']:
+        raise ValueError(f'Compact features {name} were computed on a different manifest')
+    rows = np.arange(len(df)) if rows is None else np.asarray(rows)
+    X = np.asarray(data[rows], dtype=np.float32)
+    if meta['quantization'] == 'int8':
+        X *= pca['scales']
+    X[np.isin(rows, meta['quarantined'])] = np.nan
+    return X, df['label'].to_numpy()[rows]
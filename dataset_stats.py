@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import time
+import numpy as np
+import cv2
+from preprocessing import (FEATURE_PATH, iter_chunk_results, preprocess_image, normalize_rgb_histogram,
+                           read_image_header)
+from image_cache import file_stats
+
+STATS_PATH = f'{FEATURE_PATH}/dataset_stats'
+SIZE_BINS = np.arange(0, 4097, 64)
+ASPECT_BINS = np.round(np.geomspace(0.25, 4, 33), 4)
+
+
+def _empty_moments():
+    return {'count': 0, 'mean': np.zeros(3), 'm2': np.zeros(3)}
+
+
+def merge_moments(a, b):
+    """Combine two per-channel (count, mean, M2) accumulators with Chan et al.'s parallel update"""
+    count = a['count'] + b['count']
+    if count == 0:
+        return _empty_moments()
+    delta = b['mean'] - a['mean']
+    mean = a['mean'] + delta * b['count'] / count
+    m2 = a['m2'] + b['m2'] + delta ** 2 * a['count'] * b['count'] / count
+    return {'count': count, 'mean': mean, 'm2': m2}
+
+
+def _image_moments(img):
+    """Per-channel moments of one uint8 image from a single cv2.meanStdDev call"""
+    mean, std = cv2.meanStdDev(img)
+    count = img.shape[0] * img.shape[1]
+    return {'count': count, 'mean': mean.ravel(), 'm2': std.ravel() ** 2 * count}
+
+
+def _empty_class():
+    return {'count': 0, 'width': np.zeros(len(SIZE_BINS), dtype=np.int64),
+            'height': np.zeros(len(SIZE_BINS), dtype=np.int64),
+            'aspect': np.zeros(len(ASPECT_BINS) + 1, dtype=np.int64)}
+
+
+def _empty_stats():
+    return {'raw': _empty_moments(), 'equalized': _empty_moments(), 'classes': {}, 'corrupt': []}
+
+
+def merge_stats(a, b):
+    """Merge two partial statistics accumulators"""
+    classes = {label: dict(c) for label, c in a['classes'].items()}
+    for label, c in b['classes'].items():
+        mine = classes.setdefault(label, _empty_class())
+        classes[label] = {key: mine[key] + c[key] for key in mine}
+    return {'raw': merge_moments(a['raw'], b['raw']), 'equalized': merge_moments(a['equalized'], b['equalized']),
+            'classes': classes, 'corrupt': a['corrupt'] + b['corrupt']}
+
+
+def _stats_chunk(start, items, fast):
+    """Worker entry point: accumulate the statistics of a chunk of (img_path, label_name) items"""
+    stats = _empty_stats()
+    for img_path, label in items:
+        try:
+            img = preprocess_image(img_path, fast=fast)
+        except Exception as e:
+            stats['corrupt'].append({'img_path': img_path, 'label_name': label, 'error': f'{type(e).__name__}: {e}'})
+            continue
+        stats['raw'] = merge_moments(stats['raw'], _image_moments(img))
+        stats['equalized'] = merge_moments(stats['equalized'], _image_moments(normalize_rgb_histogram(img)))
+        c = stats['classes'].setdefault(label, _empty_class())
+        c['count'] += 1
+        header = read_image_header(img_path)
+        if header is not None:
+            _, height, width = header
+            # Sizes past the last edge land in the last bin
+            c['width'][min(np.searchsorted(SIZE_BINS, width, side='right'), len(SIZE_BINS)) - 1] += 1
+            c['height'][min(np.searchsorted(SIZE_BINS, height, side='right'), len(SIZE_BINS)) - 1] += 1
+            c['aspect'][np.searchsorted(ASPECT_BINS, width / height, side='right')] += 1
+    return start, stats
+
+
+def _stats_key(df, fast):
+    """Fingerprint of the images (path, size, mtime, in any row order) and options the statistics were computed on"""
+    stats = file_stats(df).sort_values('img_path')
+    rows = '\n'.join(f'{p}\t{s}\t{m}' for p, s, m in zip(stats['img_path'], stats['size'], stats['mtime_ns']))
+    return f'{hashlib.md5(rows.encode()).hexdigest()}-fast={bool(fast)}'
+
+
+def _summary(stats):
+    """JSON-serializable summary of a merged accumulator"""
+    def channels(moments):
+        n = max(moments['count'] - 1, 1)
+        return {'mean': moments['mean'].tolist(), 'std': np.sqrt(moments['m2'] / n).tolist()}
+    return {'n_images': sum(c['count'] for c in stats['classes'].values()),
+            'channels': channels(stats['raw']), 'equalized_channels': channels(stats['equalized']),
+            'size_bins': SIZE_BINS.tolist(), 'aspect_bins': ASPECT_BINS.tolist(),
+            'classes': {label: {key: int(v) if key == 'count' else v.tolist() for key, v in c.items()}
+                        for label, c in sorted(stats['classes'].items())},
+            'corrupt_count': len(stats['corrupt']),
+            'corrupt_by_class': {label: sum(e['label_name'] == label for e in stats['corrupt'])
+                                 for label in sorted({e['label_name'] for e in stats['corrupt']})},
+            'corrupt': stats['corrupt']}
+
+
+def compute_dataset_stats(df, fast=False, n_workers=None, chunk_size=64, refresh=False, verbose=True):
+    """Channel, size and aspect ratio statistics and corrupt files of the dataframe, cached"""
+    key = _stats_key(df, fast)
+    stats_file = f'{STATS_PATH}/{hashlib.md5(key.encode()).hexdigest()[:12]}.json'
+    if not refresh and os.path.exists(stats_file):
+        with open(stats_file) as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return cached
+
+    t0 = time.perf_counter()
+    items = list(zip(df['img_path'], df['label_name']))
+    stats = _empty_stats()
+    for _, partial in iter_chunk_results(_stats_chunk, items, fast, n_workers=n_workers, chunk_size=chunk_size):
+        stats = merge_stats(stats, partial)
+    result = dict(_summary(stats), key=key)
+    os.makedirs(STATS_PATH, exist_ok=True)
+    with open(stats_file + '.tmp', 'w') as f:
+        json.dump(result, f, indent=2)
+    os.replace(stats_file + '.tmp', stats_file)
+    if verbose:
+        elapsed = time.perf_counter() - t0
+        channels = result['channels']
+        print(f"Dataset statistics of {len(df)} images in {elapsed:.1f}s: RGB mean "
+              f"{np.round(channels['mean'], 1).tolist()}, std {np.round(channels['std'], 1).tolist()}, "
+              f"{result['corrupt_count']} corrupt")
+    return result
@@ -0,0 +1,158 @@
+import os
+import numpy as np
+import pandas as pd
+import cv2
+from preprocessing import FEATURE_PATH, read_image_header, iter_chunk_results
+from image_cache import file_stats
+
+PHASH_FILE = f'{FEATURE_PATH}/phash.parquet'
+
+# Byte-wise popcount lookup table used to count differing bits between 64-bit hashes
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _load_small_grayscale(img_path, min_side=64):
+    """Decode the image as grayscale at the smallest JPEG scale keeping min_side pixels"""
+    header = read_image_header(img_path)
+    flag = cv2.IMREAD_GRAYSCALE
+    if header is not None and header[0] == 'jpeg':
+        for factor, reduced_flag in [(8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                                     (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)]:
+            if min(header[1:]) >= factor * min_side:
+                flag = reduced_flag
+                break
+    return cv2.imread(img_path, flag)
+
+
+def phash_image(img_path):
+    """64-bit DCT perceptual hash of the image"""
+    img = _load_small_grayscale(img_path)
+    if img is None:
+        raise ValueError(f'Cannot decode {img_path}')
+    img = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(img)[:8, :8].flatten()
+    # The DC term only encodes the mean brightness so it is left out of the median
+    bits = low_freq > np.median(low_freq[1:])
+    return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+
+def _phash_chunk(start, img_paths):
+    """Worker entry point: hash a chunk of images, marking the ones that cannot be decoded invalid"""
+    hashes = np.zeros(len(img_paths), dtype=np.uint64)
+    valid = np.zeros(len(img_paths), dtype=bool)
+    for i, img_path in enumerate(img_paths):
+        try:
+            hashes[i] = phash_image(img_path)
+            valid[i] = True
+        except Exception:
+            pass
+    return start, hashes, valid
+
+
+def compute_phashes(df, n_workers=None, chunk_size=256):
+    """Perceptual hashes and validity mask of every image in the dataframe, computed in parallel"""
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    valid = np.zeros(len(df), dtype=bool)
+    for start, chunk, chunk_valid in iter_chunk_results(_phash_chunk, df['img_path'].to_list(), n_workers=n_workers,
+                                                        chunk_size=chunk_size):
+        hashes[start:start + len(chunk)] = chunk
+        valid[start:start + len(chunk)] = chunk_valid
+    return hashes, valid
+
+
+def add_phash_column(df, n_workers=None, chunk_size=256):
+    """Return a copy of the dataframe with cached phash and phash_valid columns"""
+    index = file_stats(df)
+    phash = np.zeros(len(index), dtype=np.uint64)
+    valid = np.zeros(len(index), dtype=bool)
+    missing = np.ones(len(index), dtype=bool)
+    cached = None
+    if os.path.exists(PHASH_FILE):
+        cached = pd.read_parquet(PHASH_FILE)
+        if 'phash_valid' not in cached:
+            cached['phash_valid'] = True
+        # Merge on the cached row number rather than the hash so uint64 values never round-trip through float
+        rows = index.merge(cached[['img_path', 'size', 'mtime_ns']].reset_index(), on=['img_path', 'size', 'mtime_ns'],
+                           how='left')['index'].to_numpy()
+        missing = np.isnan(rows)
+        phash[~missing] = cached['phash'].to_numpy(dtype=np.uint64)[rows[~missing].astype(np.int64)]
+        valid[~missing] = cached['phash_valid'].to_numpy(dtype=bool)[rows[~missing].astype(np.int64)]
+    if missing.any():
+        phash[missing], valid[missing] = compute_phashes(df[missing], n_workers=n_workers, chunk_size=chunk_size)
+        index['phash'] = phash
+        index['phash_valid'] = valid
+        if cached is not None:
+            index = pd.concat([cached[~cached['img_path'].isin(index['img_path'])], index], ignore_index=True)
+        os.makedirs(FEATURE_PATH, exist_ok=True)
+        index.to_parquet(PHASH_FILE + '.tmp', index=False)
+        os.replace(PHASH_FILE + '.tmp', PHASH_FILE)
+    if not valid.all():
+        print(f"Could not hash {(~valid).sum()} undecodable images: {df['img_path'][~valid].to_list()}")
+    df = df.copy()
+    df['phash'] = phash
+    df['phash_valid'] = valid
+    return df
+
+
+def hamming_distance(a, b):
+    """Number of differing bits between uint64 hashes, broadcasting like numpy arithmetic"""
+    xor = np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64))
+    return _POPCOUNT_TABLE[np.ascontiguousarray(xor)[..., None].view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def find_near_duplicate_pairs(hashes, max_distance=6):
+    """(row_i, row_j, distance) of every pair of hashes at most max_distance bits apart"""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n_blocks = max_distance + 1
+    bounds = np.linspace(0, 64, n_blocks + 1).astype(np.uint64)
+    pairs = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        block = (hashes >> lo) & ((np.uint64(1) << (hi - lo)) - np.uint64(1))
+        order = np.argsort(block, kind='stable')
+        # Boundaries of the runs of equal block values in sorted order
+        run_starts = np.flatnonzero(np.r_[True, block[order][1:] != block[order][:-1]])
+        run_ends = np.r_[run_starts[1:], len(order)]
+        for run_start, run_end in zip(run_starts, run_ends):
+            if run_end - run_start < 2:
+                continue
+            members = np.sort(order[run_start:run_end])
+            i, j = np.triu_indices(len(members), k=1)
+            i, j = members[i], members[j]
+            dist = hamming_distance(hashes[i], hashes[j])
+            keep = dist <= max_distance
+            pairs.append(np.stack([i[keep], j[keep], dist[keep]], axis=1))
+    if not pairs:
+        return np.empty((0, 3), dtype=np.int64)
+    return np.unique(np.concatenate(pairs).astype(np.int64), axis=0)
+
+
+def find_near_duplicate_groups(hashes, max_distance=6):
+    """Group id of every row, joining rows connected by near-duplicate pairs"""
+    parent = np.arange(len(hashes))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j, _ in find_near_duplicate_pairs(hashes, max_distance):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([find(x) for x in range(len(hashes))])
+
+
+def filter_near_duplicates(df, max_distance=6, n_workers=None):
+    """Drop near-duplicate images, keeping the first row of each group"""
+    df = add_phash_column(df, n_workers=n_workers)
+    valid = np.flatnonzero(df['phash_valid'].to_numpy())
+    groups = np.arange(len(df))
+    groups[valid] = valid[find_near_duplicate_groups(df['phash'].to_numpy()[valid], max_distance)]
+    keep = ~pd.Series(groups).duplicated().to_numpy()
+    pre_count = df.groupby('label_name')['file_name'].count()
+    filter_df = df[keep].reset_index(inplace=False, drop=True)
+    dropped_df = df[~keep].groupby('label_name')['file_name'].count()
+    post_count = filter_df.groupby('label_name')['file_name'].count()
+    print(f"Raw class counts: {pre_count}\n\nFiltered Class Counts: {post_count}\n\nDropped Rows: {dropped_df}")
+    return filter_df
@@ -0,0 +1,445 @@
+import os
+import json
+import hashlib
+import time
+import numpy as np
+import cv2
+from skimage.feature import hog
+import profiling
+from preprocessing import (FEATURE_PATH, preprocess_image, rgb_to_grayscale, rgb_to_grayscale_batch,
+                           iter_chunk_results)
+from image_cache import file_stats, IMAGE_SHAPE
+
+RESNET_DIMS = 2048
+_resnet_models = {}
+
+
+def manifest_hash(df):
+    """Fingerprint of the dataframe row order so features are never served for a different manifest"""
+    return hashlib.md5('\n'.join(df['img_path']).encode()).hexdigest()
+
+
+def content_fingerprints(df):
+    """Per-row uint64 fingerprint of the image file contents derived from file size and modification time"""
+    stats = file_stats(df)
+    size = stats['size'].to_numpy().astype(np.uint64)
+    return size * np.uint64(0x9E3779B97F4A7C15) ^ stats['mtime_ns'].to_numpy().astype(np.uint64)
+
+
+def _feature_files(name):
+    """Return the data, metadata, progress, fingerprint and quarantine file names for a named feature matrix"""
+    base = f'{FEATURE_PATH}/{name}'
+    return f'{base}.npy', f'{base}.json', f'{base}_done.npy', f'{base}_fingerprints.npy', f'{base}_quarantine.json'
+
+
+def _row_shape(n_dims):
+    """Shape of one row of a feature matrix from an int or a shape tuple"""
+    return tuple(int(d) for d in np.atleast_1d(n_dims))
+
+
+def _save_npy(file_name, array):
+    np.save(file_name + '.tmp.npy', array)
+    os.replace(file_name + '.tmp.npy', file_name)
+
+
+def open_feature_store(name, meta, n_rows, n_dims, dtype=np.float32, fingerprints=None):
+    """Open the resumable memory-mapped feature matrix and progress mask of a job, restarting on new meta"""
+    data_file, meta_file, done_file, fingerprint_file, quarantine_file = _feature_files(name)
+    # Round trip through json so tuples and lists compare equal against the recorded metadata
+    meta = json.loads(json.dumps(dict(meta, n_rows=n_rows, n_dims=n_dims, dtype=np.dtype(dtype).name)))
+    if all(os.path.exists(f) for f in (data_file, meta_file, done_file)):
+        with open(meta_file) as f:
+            if json.load(f) == meta:
+                data, done = np.load(data_file, mmap_mode='r+'), np.load(done_file)
+                if fingerprints is not None:
+                    old = np.load(fingerprint_file) if os.path.exists(fingerprint_file) else None
+                    stale = done & (old != fingerprints) if old is not None and len(old) == n_rows else done.copy()
+                    if stale.any():
+                        done[stale] = False
+                        save_progress(name, done)
+                        quarantine = load_quarantine(name)
+                        save_quarantine(name, {row: e for row, e in quarantine.items() if not stale[row]})
+                    # Saved after the progress mask so a crash in between can only cause extra recomputation
+                    _save_npy(fingerprint_file, fingerprints)
+                return data, done
+
+    os.makedirs(FEATURE_PATH, exist_ok=True)
+    for f in (meta_file, done_file, fingerprint_file, quarantine_file):
+        if os.path.exists(f):
+            os.remove(f)
+    data = np.lib.format.open_memmap(data_file, mode='w+', dtype=dtype, shape=(n_rows,) + _row_shape(n_dims))
+    done = np.zeros(n_rows, dtype=bool)
+    save_progress(name, done)
+    if fingerprints is not None:
+        _save_npy(fingerprint_file, fingerprints)
+    # The metadata is written last and marks the store as valid
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f, indent=2)
+    return data, done
+
+
+def save_progress(name, done):
+    """Atomically record which rows of the named feature matrix have been written"""
+    _save_npy(_feature_files(name)[2], done)
+
+
+def load_quarantine(name):
+    """Rows of the named feature matrix whose image could not be processed, as {row: {'img_path', 'error'}}"""
+    quarantine_file = _feature_files(name)[4]
+    if not os.path.exists(quarantine_file):
+        return {}
+    with open(quarantine_file) as f:
+        return {int(row): entry for row, entry in json.load(f).items()}
+
+
+def save_quarantine(name, quarantine):
+    """Atomically replace the quarantine list of the named feature matrix"""
+    quarantine_file = _feature_files(name)[4]
+    with open(quarantine_file + '.tmp', 'w') as f:
+        json.dump({str(row): entry for row, entry in sorted(quarantine.items())}, f, indent=2)
+    os.replace(quarantine_file + '.tmp', quarantine_file)
+
+
+def pending_chunk_starts(done, chunk_size):
+    """Start rows of the chunks that still contain unfinished rows"""
+    return [start for start in range(0, len(done), chunk_size) if not done[start:start + chunk_size].all()]
+
+
+def load_features(name, df=None):
+    """Return the read-only memory-mapped feature matrix and its metadata, optionally checked against df"""
+    data_file, meta_file, done_file = _feature_files(name)[:3]
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if df is not None and meta['manifest'] != manifest_hash(df):
+        raise ValueError(f'Feature matrix {name} was computed on a different manifest')
+    if not np.load(done_file).all():
+        raise ValueError(f'Feature matrix {name} is incomplete, rerun its extraction to resume it')
+    meta['quarantined'] = sorted(load_quarantine(name))
+    return np.load(data_file, mmap_mode='r'), meta
+
+
+def _apply_quarantined(func, img_paths, n_dims, dtype):
+    """Apply func to every image path of a chunk, returning (rows, {offset: error}) for failed images"""
+    fill = np.nan if np.issubdtype(dtype, np.floating) else 0
+    out = np.full((len(img_paths),) + _row_shape(n_dims), fill, dtype=dtype)
+    failed = {}
+    for i, img_path in enumerate(img_paths):
+        try:
+            out[i] = func(img_path)
+        except Exception as e:
+            failed[i] = f'{type(e).__name__}: {e}'
+    return out, failed
+
+
+def _update_quarantine(quarantine, start, img_paths, failed):
+    """Record the failures of the chunk starting at row start and forget earlier failures of rows that now worked"""
+    for offset in range(len(img_paths)):
+        quarantine.pop(start + offset, None)
+    for offset, error in failed.items():
+        quarantine[start + offset] = {'img_path': img_paths[offset], 'error': error}
+
+
+def run_feature_job(df, name, meta, n_dims, dtype, chunk_func, *args, label='Job', n_workers=None, chunk_size=64,
+                    verbose=True):
+    """Checkpointed, resumable chunk_func job over every row of the dataframe into the store name"""
+    data, done = open_feature_store(name, meta, len(df), n_dims, dtype, fingerprints=content_fingerprints(df))
+    quarantine = load_quarantine(name)
+    img_paths = df['img_path'].to_list()
+
+    t0 = time.perf_counter()
+    chunk_starts = pending_chunk_starts(done, chunk_size)
+    n_images = 0
+    for start, rows, failed in iter_chunk_results(chunk_func, img_paths, *args, n_workers=n_workers,
+                                                  chunk_size=chunk_size, chunk_starts=chunk_starts):
+        data[start:start + len(rows)] = rows
+        data.flush()
+        _update_quarantine(quarantine, start, img_paths[start:start + len(rows)], failed)
+        save_quarantine(name, quarantine)
+        done[start:start + len(rows)] = True
+        save_progress(name, done)
+        n_images += len(rows)
+    elapsed = time.perf_counter() - t0
+    if verbose and n_images:
+        print(f"{label}: processed {n_images} images in {elapsed:.1f}s ({n_images / max(elapsed, 1e-9):.1f} "
+              f"images/sec), {len(quarantine)} quarantined")
+    del data
+    return load_features(name, df)[0]
+
+
+def _preprocess_quarantined_chunk(start, img_paths, equalize, fast):
+    """Worker entry point: preprocess a chunk of images, quarantining the ones that cannot be decoded"""
+    imgs, failed = _apply_quarantined(lambda p: preprocess_image(p, equalize=equalize, fast=fast), img_paths,
+                                      IMAGE_SHAPE, np.uint8)
+    return start, imgs, failed
+
+
+def preprocess_images_job(df, equalize=False, fast=False, name='images', n_workers=None, chunk_size=64,
+                          verbose=True):
+    """Checkpointed preprocessing of every row into an N x 256 x 256 x 3 uint8 store"""
+    meta = {'feature': 'images', 'equalize': bool(equalize), 'fast': bool(fast), 'manifest': manifest_hash(df)}
+    return run_feature_job(df, name, meta, IMAGE_SHAPE, np.uint8, _preprocess_quarantined_chunk, equalize, fast,
+                           label='Preprocessing', n_workers=n_workers, chunk_size=chunk_size, verbose=verbose)
+
+
+def _hog_chunk(start, img_paths, hog_params, n_dims, equalize, fast, dtype):
+    """Worker entry point: preprocess a chunk of images and compute their HOG descriptors"""
+    def describe(img_path):
+        gray = rgb_to_grayscale(preprocess_image(img_path, equalize=equalize, fast=fast))
+        with profiling.stage('hog'):
+            return hog(gray, feature_vector=True, **hog_params)
+    feats, failed = _apply_quarantined(describe, img_paths, n_dims, dtype)
+    return start, feats, failed
+
+
+def extract_hog_features(df, orientations=9, pixels_per_cell=(8, 8), cells_per_block=(3, 3), block_norm='L2-Hys',
+                         dtype=np.float32, equalize=False, fast=False, name='hog', n_workers=None, chunk_size=64,
+                         verbose=True):
+    """Checkpointed parallel HOG extraction of every row into a memory-mapped matrix"""
+    hog_params = {'orientations': orientations, 'pixels_per_cell': tuple(pixels_per_cell),
+                  'cells_per_block': tuple(cells_per_block), 'block_norm': block_norm}
+    n_dims = hog(np.zeros((256, 256)), feature_vector=True, **hog_params).size
+    meta = {'feature': 'hog', 'params': hog_params, 'equalize': bool(equalize), 'fast': bool(fast),
+            'manifest': manifest_hash(df)}
+    return run_feature_job(df, name, meta, n_dims, dtype, _hog_chunk, hog_params, n_dims, equalize, fast, dtype,
+                           label='HOG', n_workers=n_workers, chunk_size=chunk_size, verbose=verbose)
+
+
+def build_resnet_embedder(weights='imagenet', n_threads=None):
+    """Cached CPU ResNet101 with global average pooling and no classifier head"""
+    import tensorflow as tf
+    if n_threads and tf.config.threading.get_intra_op_parallelism_threads() != n_threads:
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        except RuntimeError:
+            print(f"TensorFlow is already initialized in this process, n_threads={n_threads} is ignored")
+    if weights not in _resnet_models:
+        from tensorflow.keras.applications.resnet import ResNet101
+        try:
+            tf.config.set_visible_devices([], 'GPU')
+        except RuntimeError:
+            pass  # the TensorFlow runtime is already initialized in this process
+        _resnet_models[weights] = ResNet101(include_top=False, weights=weights, pooling='avg',
+                                            input_shape=(256, 256, 3))
+    return _resnet_models[weights]
+
+
+def extract_resnet_embeddings(df, batch_size=32, n_threads=None, weights='imagenet', equalize=False, fast=False,
+                              name='resnet101', n_workers=None, checkpoint_every=10, verbose=True):
+    """Checkpointed 2048-d ResNet101 embedding of every row into a memory-mapped matrix"""
+    from tensorflow.keras.applications.resnet import preprocess_input
+    meta = {'feature': 'resnet101', 'weights': weights, 'equalize': bool(equalize), 'fast': bool(fast),
+            'manifest': manifest_hash(df)}
+    data, done = open_feature_store(name, meta, len(df), RESNET_DIMS, np.float32,
+                                    fingerprints=content_fingerprints(df))
+    quarantine = load_quarantine(name)
+    img_paths = df['img_path'].to_list()
+    chunks = iter_chunk_results(_preprocess_quarantined_chunk, img_paths, equalize, fast, n_workers=n_workers,
+                                chunk_size=batch_size, chunk_starts=pending_chunk_starts(done, batch_size))
+
+    t0 = time.perf_counter()
+    n_images = 0
+    model = None
+    for n_batches, (start, imgs, failed) in enumerate(chunks, start=1):
+        if model is None:
+            # Built after the first batch so the decode workers are forked before TensorFlow starts its thread pools
+            model = build_resnet_embedder(weights, n_threads)
+        with profiling.stage('resnet_batch'):
+            emb = model(preprocess_input(imgs.astype(np.float32)), training=False).numpy()
+        emb[list(failed)] = np.nan
+        data[start:start + len(emb)] = emb
+        _update_quarantine(quarantine, start, img_paths[start:start + len(emb)], failed)
+        done[start:start + len(emb)] = True
+        n_images += len(emb)
+        if n_batches % checkpoint_every == 0:
+            data.flush()
+            save_quarantine(name, quarantine)
+            save_progress(name, done)
+    data.flush()
+    save_quarantine(name, quarantine)
+    save_progress(name, done)
+    elapsed = time.perf_counter() - t0
+    if verbose and n_images:
+        print(f"ResNet101: embedded {n_images} images in {elapsed:.1f}s "
+              f"({n_images / max(elapsed, 1e-9):.1f} images/sec), {len(quarantine)} quarantined")
+    del data
+    return load_features(name, df)[0]
+
+
+FEATURE_EXTRACTORS = {}
+
+
+def register_extractor(name):
+    """Decorator adding a batched N x 256 x 256 x 3 uint8 -> N x D extractor to FEATURE_EXTRACTORS"""
+    def decorator(func):
+        FEATURE_EXTRACTORS[name] = func
+        return func
+    return decorator
+
+
+def _channel_histograms(imgs, ranges, bins):
+    """Per-channel histograms of every image, normalized to sum to one per channel"""
+    hist = np.empty((len(imgs), 3, bins), dtype=np.float32)
+    for i, img in enumerate(imgs):
+        for c in range(3):
+            hist[i, c] = cv2.calcHist([img], [c], None, [bins], ranges[c]).ravel()
+    return (hist / (imgs.shape[1] * imgs.shape[2])).reshape(len(imgs), -1)
+
+
+@register_extractor('rgb_hist')
+def rgb_histograms(imgs, bins=32):
+    """Per-channel RGB histograms with bins bins per channel"""
+    return _channel_histograms(imgs, [[0, 256]] * 3, bins)
+
+
+@register_extractor('hsv_hist')
+def hsv_histograms(imgs, bins=32):
+    """Per-channel HSV histograms with bins bins per channel"""
+    n, h, w = imgs.shape[:3]
+    hsv = cv2.cvtColor(np.ascontiguousarray(imgs).reshape(n * h, w, 3), cv2.COLOR_RGB2HSV).reshape(n, h, w, 3)
+    return _channel_histograms(hsv, [[0, 180], [0, 256], [0, 256]], bins)
+
+
+def _uniform_lbp_table():
+    """Rotation invariant uniform label (0-9) of each of the 256 8-bit LBP codes"""
+    codes = np.arange(256)
+    bits = (codes[:, None] >> np.arange(8)) & 1
+    transitions = (bits != np.roll(bits, 1, axis=1)).sum(axis=1)
+    return np.where(transitions <= 2, bits.sum(axis=1), 9).astype(np.uint8)
+
+
+_LBP_LABELS = _uniform_lbp_table()
+# The 8 neighbors of the 3x3 block in circular order
+_LBP_NEIGHBORS = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+
+
+@register_extractor('lbp')
+def lbp_histograms(imgs, grid=4):
+    """Uniform LBP histograms of the grayscale images on a grid x grid layout of cells"""
+    gray = rgb_to_grayscale_batch(imgs, dtype=np.uint8)
+    n, h, w = gray.shape
+    center = gray[:, 1:-1, 1:-1]
+    codes = np.zeros(center.shape, dtype=np.uint8)
+    for bit, (dy, dx) in enumerate(_LBP_NEIGHBORS):
+        codes |= (gray[:, 1 + dy:h - 1 + dy, 1 + dx:w - 1 + dx] >= center).astype(np.uint8) << bit
+    cell_rows = np.arange(h - 2) * grid // (h - 2)
+    cell_cols = np.arange(w - 2) * grid // (w - 2)
+    cells = (cell_rows[:, None] * grid + cell_cols[None]) * 10
+    index = _LBP_LABELS[codes] + cells + (np.arange(n) * grid * grid * 10)[:, None, None]
+    hist = np.bincount(index.ravel(), minlength=n * grid * grid * 10).reshape(n, grid * grid, 10)
+    return (hist / hist.sum(axis=2, keepdims=True)).reshape(n, -1).astype(np.float32)
+
+
+_gabor_banks = {}
+
+
+def _gabor_size(size, wavelength):
+    """Smallest power of two grid, at most size, that holds a Gabor filter of the given wavelength"""
+    cutoff = (1 + 3 / (2 * np.pi * 0.56)) / wavelength
+    return min(size, 2 ** int(np.ceil(np.log2(2 * cutoff * size))))
+
+
+def _crop_spectrum(spectrum, m):
+    """Real FFTs of square images resampled to an m x m grid"""
+    if m == spectrum.shape[-2]:
+        return spectrum
+    return np.concatenate([spectrum[..., :m // 2, :m // 2 + 1], spectrum[..., -(m // 2):, :m // 2 + 1]], axis=-2)
+
+
+def _gabor_bank(size, wavelengths, n_orientations):
+    """Cached real FFTs of the even and odd Gabor kernels per wavelength, as [(grid size, even, odd)]"""
+    key = (size, tuple(wavelengths), n_orientations)
+    if key not in _gabor_banks:
+        from scipy import fft
+        y, x = np.meshgrid(np.fft.fftfreq(size, 1 / size), np.fft.fftfreq(size, 1 / size), indexing='ij')
+        bank = []
+        for wavelength in wavelengths:
+            sigma = 0.56 * wavelength
+            envelope = np.exp(-(x ** 2 + y ** 2) / (2 * sigma ** 2))
+            envelope /= envelope.sum()
+            even, odd = [], []
+            for theta in np.arange(n_orientations) * np.pi / n_orientations:
+                x_theta = x * np.cos(theta) + y * np.sin(theta)
+                real = envelope * np.cos(2 * np.pi * x_theta / wavelength)
+                even.append(real - envelope * real.sum())
+                odd.append(envelope * np.sin(2 * np.pi * x_theta / wavelength))
+            m = _gabor_size(size, wavelength)
+            # The inverse FFT on the m x m grid divides by m^2 instead of size^2
+            scale = (m / size) ** 2
+            bank.append((m, scale * _crop_spectrum(fft.rfft2(np.array(even, dtype=np.float32)), m),
+                         scale * _crop_spectrum(fft.rfft2(np.array(odd, dtype=np.float32)), m)))
+        _gabor_banks[key] = bank
+    return _gabor_banks[key]
+
+
+@register_extractor('gabor')
+def gabor_features(imgs, wavelengths=(4, 8, 16, 32), n_orientations=4):
+    """Mean and std of the Gabor energy of the grayscale images per wavelength and orientation"""
+    from scipy import fft
+    gray = rgb_to_grayscale_batch(imgs)
+    spectrum = fft.rfft2(gray)
+    feats = np.empty((len(imgs), len(wavelengths), n_orientations, 2), dtype=np.float32)
+    for i, (m, even, odd) in enumerate(_gabor_bank(gray.shape[1], wavelengths, n_orientations)):
+        cropped = _crop_spectrum(spectrum, m)
+        for j in range(n_orientations):
+            energy = np.hypot(fft.irfft2(cropped * even[j], s=(m, m)), fft.irfft2(cropped * odd[j], s=(m, m)))
+            feats[:, i, j, 0] = energy.mean(axis=(1, 2))
+            feats[:, i, j, 1] = energy.std(axis=(1, 2))
+    return feats.reshape(len(imgs), -1)
+
+
+def _extract_chunk(start, img_paths, families, equalize, fast):
+    """Worker entry point: preprocess a chunk once and run every requested extractor on it"""
+    _, imgs, failed = _preprocess_quarantined_chunk(start, img_paths, equalize, fast)
+    ok = np.ones(len(img_paths), dtype=bool)
+    ok[list(failed)] = False
+    results = {}
+    for name, extractor, params, n_dims in families:
+        rows = np.full((len(img_paths), n_dims), np.nan, dtype=np.float32)
+        if ok.any():
+            with profiling.stage(extractor):
+                rows[ok] = FEATURE_EXTRACTORS[extractor](imgs[ok], **params)
+        results[name] = rows
+    return start, results, failed
+
+
+def extract_features(df, extractors=('rgb_hist', 'hsv_hist', 'lbp', 'gabor'), equalize=False, fast=False,
+                     n_workers=None, chunk_size=64, verbose=True):
+    """Run several registered extractors over every row into one checkpointed store each"""
+    if not isinstance(extractors, dict):
+        extractors = {name: {} for name in extractors}
+    fingerprints = content_fingerprints(df)
+    img_paths = df['img_path'].to_list()
+    families, stores = [], {}
+    for extractor, params in extractors.items():
+        # Output width from a blank image, like the HOG path
+        n_dims = FEATURE_EXTRACTORS[extractor](np.zeros((1,) + IMAGE_SHAPE, dtype=np.uint8), **params).shape[1]
+        meta = {'feature': extractor, 'params': params, 'equalize': bool(equalize), 'fast': bool(fast),
+                'manifest': manifest_hash(df)}
+        data, done = open_feature_store(extractor, meta, len(df), n_dims, np.float32, fingerprints=fingerprints)
+        stores[extractor] = (data, done, load_quarantine(extractor))
+        families.append((extractor, extractor, params, n_dims))
+
+    t0 = time.perf_counter()
+    chunk_starts = sorted(set().union(*[pending_chunk_starts(done, chunk_size) for _, done, _ in stores.values()]))
+    n_images = 0
+    for start, results, failed in iter_chunk_results(_extract_chunk, img_paths, families, equalize, fast,
+                                                     n_workers=n_workers, chunk_size=chunk_size,
+                                                     chunk_starts=chunk_starts):
+        for name, rows in results.items():
+            data, done, quarantine = stores[name]
+            data[start:start + len(rows)] = rows
+            data.flush()
+            _update_quarantine(quarantine, start, img_paths[start:start + len(rows)], failed)
+            save_quarantine(name, quarantine)
+            done[start:start + len(rows)] = True
+            save_progress(name, done)
+        n_images += len(img_paths[start:start + chunk_size])
+    elapsed = time.perf_counter() - t0
+    if verbose and n_images:
+        print(f"Extracted {', '.join(stores)} for {n_images} images in {elapsed:.1f}s "
+              f"({n_images / max(elapsed, 1e-9):.1f} images/sec)")
+    features = {}
+    for name, (data, _, _) in stores.items():
+        del data
+        features[name] = load_features(name, df)[0]
+    return features
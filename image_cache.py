@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import time
+import numpy as np
+import pandas as pd
+from preprocessing import FEATURE_PATH, iter_chunk_results, _preprocess_chunk
+
+IMAGE_CACHE_PATH = f'{FEATURE_PATH}/image_cache'
+IMAGE_SHAPE = (256, 256, 3)
+
+
+def _cache_files(params, path=IMAGE_CACHE_PATH, prefix='images'):
+    """Return the data and index file names for a set of preprocessing parameters"""
+    key = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+    return f'{path}/{prefix}_{key}.npy', f'{path}/{prefix}_{key}_index.csv'
+
+
+def file_stats(df):
+    """Build the cache index for the dataframe: image path, file size and modification time"""
+    stats = [os.stat(p) for p in df['img_path']]
+    return pd.DataFrame({'img_path': df['img_path'].to_list(),
+                         'size': np.array([s.st_size for s in stats], dtype=np.int64),
+                         'mtime_ns': np.array([s.st_mtime_ns for s in stats], dtype=np.int64)})
+
+
+def load_image_cache(df, equalize=False, fast=False, n_workers=None, chunk_size=64, verbose=True):
+    """Return the read-only memory-mapped M x 256 x 256 x 3 uint8 image cache and the cache row of every df row"""
+    params = {'size': IMAGE_SHAPE[0], 'equalize': bool(equalize), 'fast': bool(fast)}
+    return load_row_cache(df, IMAGE_CACHE_PATH, 'images', params, IMAGE_SHAPE, _preprocess_chunk, equalize, fast,
+                          n_workers=n_workers, chunk_size=chunk_size, label='Image cache', verbose=verbose)
+
+
+def gather_rows(data, rows):
+    """Copy data[rows] into memory in storage order, or return data itself when rows cover it in order"""
+    if len(rows) == len(data) and (rows == np.arange(len(data))).all():
+        return data
+    order = np.argsort(rows, kind='stable')
+    out = np.empty((len(rows),) + data.shape[1:], dtype=data.dtype)
+    out[order] = data[rows[order]]
+    return out
+
+
+def load_row_cache(df, path, prefix, params, shape, chunk_func, *args, n_workers=None, chunk_size=64, label='Cache',
+                   verbose=True):
+    """Path-keyed incremental uint8 row store of the manifest images, returning (data, rows of df)"""
+    data_file, index_file = _cache_files(params, path, prefix)
+    index = file_stats(df)
+
+    old_data, old_index = None, pd.DataFrame({'img_path': pd.Series(dtype=str), 'size': pd.Series(dtype=np.int64),
+                                              'mtime_ns': pd.Series(dtype=np.int64)})
+    if os.path.exists(data_file) and os.path.exists(index_file):
+        data = np.load(data_file, mmap_mode='r')
+        stored = pd.read_csv(index_file, dtype={'img_path': str, 'size': np.int64, 'mtime_ns': np.int64})
+        if data.shape == (len(stored),) + tuple(shape):
+            old_data, old_index = data, stored
+    lookup = index.merge(old_index.reset_index(), on='img_path', how='left', suffixes=('', '_old'))
+    fresh = (lookup['size'] == lookup['size_old']) & (lookup['mtime_ns'] == lookup['mtime_ns_old'])
+    if old_data is not None and fresh.all():
+        return old_data, lookup['index'].to_numpy(dtype=np.int64)
+
+    t0 = time.perf_counter()
+    from preprocessing import load_manifest
+    manifest = load_manifest()
+    new_index = file_stats(pd.concat([manifest[['img_path']], df[['img_path']]]).drop_duplicates('img_path'))
+    # Rows of unchanged images are copied from the previous store, everything else is decoded
+    merged = new_index.reset_index().merge(old_index.reset_index(), on=['img_path', 'size', 'mtime_ns'],
+                                           how='left', suffixes=('', '_old'))
+    merged = merged[merged['index_old'].notna()]
+    fresh_rows = merged['index'].to_numpy(dtype=np.int64)
+    old_rows = merged['index_old'].to_numpy(dtype=np.int64)
+    os.makedirs(path, exist_ok=True)
+    tmp_file = data_file[:-len('.npy')] + '.tmp.npy'
+    out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(len(new_index),) + tuple(shape))
+    for i in range(0, len(fresh_rows), 1024):
+        out[fresh_rows[i:i + 1024]] = old_data[old_rows[i:i + 1024]]
+
+    stale_rows = np.setdiff1d(np.arange(len(new_index)), fresh_rows)
+    if len(stale_rows):
+        stale_paths = new_index['img_path'].to_numpy()[stale_rows].tolist()
+        for start, rows in iter_chunk_results(chunk_func, stale_paths, *args, n_workers=n_workers,
+                                              chunk_size=chunk_size):
+            out[stale_rows[start:start + len(rows)]] = rows
+    out.flush()
+    del out, old_data
+
+    # Drop the old index first so an interrupted write can never pair stale data with a valid index
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    os.replace(tmp_file, data_file)
+    new_index.to_csv(index_file + '.tmp', index=False)
+    os.replace(index_file + '.tmp', index_file)
+    if verbose:
+        elapsed = time.perf_counter() - t0
+        print(f"{label}: reused {len(fresh_rows)}, rebuilt {len(stale_rows)} images in {elapsed:.1f}s")
+    rows = pd.Series(np.arange(len(new_index)), index=new_index['img_path'])[index['img_path']].to_numpy()
+    return np.load(data_file, mmap_mode='r'), rows.astype(np.int64)
@@ -1,61 +1,170 @@
 import pandas as pd
 import numpy as np
-from skimage.transform import rescale, rotate, resize
 import cv2
 import random
-import matplotlib.pyplot as plt
 import os
-import seaborn as sns
-from skimage.feature import hog
-from skimage import exposure
-from tensorflow.keras.applications.resnet import ResNet101
+import time
+import struct
+import importlib
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import profiling
 random.seed(12345)
 np.random.seed(12345)  # Make sure the samples are repeatable
 
 # data source path is one level up from this project directory and names 'archive'
 DATA_PATH = '../archive/raw-img'
 FEATURE_PATH = '../archive/features'
+MANIFEST_FILE = f'{FEATURE_PATH}/manifest.parquet'
+MANIFEST_DIRS_FILE = f'{FEATURE_PATH}/manifest_dirs.json'
+MANIFEST_COLUMNS = ['file_name', 'label_name', 'img_path', 'label', 'size', 'mtime_ns', 'format', 'width', 'height']
 
+# Dictionary supplied with data set to translate Italian labels to English
+TRANSLATE = {"cane": "dog", "cavallo": "horse", "elefante": "elephant", "farfalla": "butterfly",
+             "gallina": "chicken", "gatto": "cat", "mucca": "cow", "pecora": "sheep", "ragno": "spider",
+             "scoiattolo": "squirrel"}
 
-def load_raw_dataframe():
-    """Load the file names and classes into a single dataframe and translate the class names from Italian to English"""
-    # Dictionary supplied with data set to translate Italian labels to English
-    translate = {"cane": "dog", "cavallo": "horse", "elefante": "elephant", "farfalla": "butterfly",
-                 "gallina": "chicken", "gatto": "cat", "mucca": "cow", "pecora": "sheep", "ragno": "spider",
-                 "scoiattolo": "squirrel"}
+LABEL_TO_NUM = {"dog": 0, "horse": 1, "elephant": 2, "butterfly": 3, "chicken": 4, "cat": 5, "cow": 6, "sheep": 7,
+                "spider": 8, "squirrel": 9}
+
+# Worst case per-image mean and 99th percentile absolute pixel difference (0-255 scale) between preprocess_image with
+# fast=True and the skimage path, rounded up from benchmarks/fast_mode_accuracy.py. The typical image differs by
+# 0.1 / 1 (area vs gaussian anti-aliasing); the worst are JPEGs of 512-1023px decoded at 1/2 resolution, up to 4.6 / 18
+FAST_MODE_TOLERANCE = {'mean_abs': 5.0, 'p99_abs': 20}
+
+# scikit-image, matplotlib, seaborn and TensorFlow are only imported by the functions that use them so that pool
+# workers and scripts that only need the manifest or the OpenCV helpers start quickly. They remain reachable as module
+# attributes (e.g. preprocessing.hog) and are imported on first access
+_LAZY_ATTRIBUTES = {'plt': ('matplotlib.pyplot', None), 'sns': ('seaborn', None),
+                    'rescale': ('skimage.transform', 'rescale'), 'rotate': ('skimage.transform', 'rotate'),
+                    'resize': ('skimage.transform', 'resize'), 'hog': ('skimage.feature', 'hog'),
+                    'exposure': ('skimage.exposure', None), 'img_as_ubyte': ('skimage', 'img_as_ubyte'),
+                    'ResNet101': ('tensorflow.keras.applications.resnet', 'ResNet101')}
+
+
+def __getattr__(name):
+    """Import the heavy dependencies listed in _LAZY_ATTRIBUTES on first attribute access"""
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attr = _LAZY_ATTRIBUTES[name]
+    value = importlib.import_module(module_name)
+    if attr is not None:
+        value = getattr(value, attr)
+    globals()[name] = value
+    return value
 
-    label_to_num = {"dog": 0, "horse": 1, "elephant": 2, "butterfly": 3, "chicken": 4, "cat": 5, "cow": 6, "sheep": 7,
-                    "spider": 8, "squirrel": 9}
 
+def load_raw_dataframe():
+    """Load the file names and classes into a single dataframe and translate the class names from Italian to English"""
     class_paths = [d for d in os.listdir(DATA_PATH) if d != '.DS_Store']
     class_files = {d: os.listdir(f'{DATA_PATH}/{d}') for d in class_paths}
     files_df = []
     for class_name in class_files.keys():
         df = pd.DataFrame(class_files[class_name], columns=['file_name'])
-        df['label_name'] = translate[class_name]
+        df['label_name'] = TRANSLATE[class_name]
         root_path = f'{DATA_PATH}/{class_name}'
-        df['img_path'] = df.apply(lambda x: f'{root_path}/{x.file_name}', axis=1)
-        df['label'] = label_to_num[translate[class_name]]
+        df['img_path'] = root_path + '/' + df['file_name']
+        df['label'] = LABEL_TO_NUM[TRANSLATE[class_name]]
         files_df.append(df)
     files_df = pd.concat(files_df).reset_index(inplace=False, drop=True)
     return files_df
 
 
-def show_class_samples(df, n_samples=5):
-    """For each class name display n_samples random samples of the class"""
-    unique_labels = df['label_name'].unique()
-    for label in unique_labels:
-        fig, ax = plt.subplots(ncols=n_samples, figsize=(20, 5))
-        fig.suptitle(f'{label.capitalize()}', fontsize=60)
-        img_samples = df[df['label_name'] == label]['img_path'].sample(n_samples, random_state=12345).to_list()
-        for col in range(n_samples):
-            img = cv2.imread(img_samples[col])
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            ax[col].imshow(img)
-            ax[col].axis('off')
-            ax[col].set_aspect('equal')
-        fig.tight_layout()
+def _scan_class_dir(class_name, cached_rows=None):
+    """Manifest rows of one class directory, reusing the cached headers of unchanged files"""
+    root_path = f'{DATA_PATH}/{class_name}'
+    names, sizes, mtimes = [], [], []
+    with os.scandir(root_path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            names.append(entry.name)
+            sizes.append(stat.st_size)
+            mtimes.append(stat.st_mtime_ns)
+    df = pd.DataFrame({'file_name': names, 'size': np.array(sizes, dtype=np.int64),
+                       'mtime_ns': np.array(mtimes, dtype=np.int64)})
+    df = df.sort_values('file_name', ignore_index=True)
+    df['label_name'] = TRANSLATE[class_name]
+    df['img_path'] = root_path + '/' + df['file_name']
+    df['label'] = LABEL_TO_NUM[TRANSLATE[class_name]]
+
+    header_columns = ['format', 'height', 'width']
+    if cached_rows is not None:
+        df = df.merge(cached_rows[['file_name', 'size', 'mtime_ns'] + header_columns],
+                      on=['file_name', 'size', 'mtime_ns'], how='left')
+    else:
+        df[header_columns] = np.nan
+    unknown = df['format'].isna()
+    headers = pd.DataFrame([read_image_header(p) or ('unknown', 0, 0) for p in df.loc[unknown, 'img_path']],
+                           columns=header_columns, index=df.index[unknown])
+    for column in header_columns:
+        df[column] = df[column].where(~unknown, headers[column])
+    df['format'] = df['format'].astype(str)
+    df[['width', 'height']] = df[['width', 'height']].astype(np.int64)
+    return df[MANIFEST_COLUMNS]
+
+
+def load_manifest(refresh=False):
+    """Load the dataset manifest from its parquet cache, rescanning only changed class directories"""
+    class_names = sorted(d for d in os.listdir(DATA_PATH) if d in TRANSLATE)
+    dir_mtimes = {d: os.stat(f'{DATA_PATH}/{d}').st_mtime_ns for d in class_names}
+
+    cached, cached_mtimes = None, {}
+    if os.path.exists(MANIFEST_FILE) and os.path.exists(MANIFEST_DIRS_FILE):
+        with open(MANIFEST_DIRS_FILE) as f:
+            cached_mtimes = json.load(f)
+        cached = pd.read_parquet(MANIFEST_FILE)
+        if not refresh and cached_mtimes == dir_mtimes:
+            return cached
+
+    parts = []
+    for class_name in class_names:
+        cached_rows = None
+        if cached is not None:
+            cached_rows = cached[cached['label_name'] == TRANSLATE[class_name]]
+            if not refresh and cached_mtimes.get(class_name) == dir_mtimes[class_name]:
+                parts.append(cached_rows)
+                continue
+        parts.append(_scan_class_dir(class_name, cached_rows))
+    manifest = pd.concat(parts, ignore_index=True)
+
+    os.makedirs(FEATURE_PATH, exist_ok=True)
+    if os.path.exists(MANIFEST_DIRS_FILE):
+        os.remove(MANIFEST_DIRS_FILE)
+    manifest.to_parquet(MANIFEST_FILE + '.tmp', index=False)
+    os.replace(MANIFEST_FILE + '.tmp', MANIFEST_FILE)
+    # The directory mtimes are written last and mark the cached manifest as valid
+    with open(MANIFEST_DIRS_FILE, 'w') as f:
+        json.dump(dir_mtimes, f)
+    return manifest
+
+
+def show_class_samples(df, n_samples=5, thumbnails=None, ax=None):
+    """For each class name display n_samples random samples of the class as one mosaic"""
+    import matplotlib.pyplot as plt
+    from thumbnails import load_thumbnail_store, sample_rows, class_mosaic
+    samples = sample_rows(df, n_samples)
+    if thumbnails is None:
+        thumbnails, rows = load_thumbnail_store(df, verbose=False)
+        samples = {label: rows[sample] for label, sample in samples.items()}
+    mosaic = class_mosaic(thumbnails, samples, n_samples)
+    size = thumbnails.shape[1]
+    standalone = ax is None
+    if standalone:
+        _, ax = plt.subplots(figsize=(2 * n_samples, 2 * len(samples)))
+    ax.imshow(mosaic, interpolation='nearest')
+    ax.set_yticks((np.arange(len(samples)) + 0.5) * size)
+    ax.set_yticklabels([label.capitalize() for label in samples], fontsize=14)
+    ax.set_xticks([])
+    ax.tick_params(length=0)
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    if standalone:
+        ax.figure.tight_layout()
         plt.show()
+    return ax
 
 
 def filter_mislabeled_images(df):
@@ -505,8 +614,10 @@ def filter_mislabeled_images(df):
     return filter_df
 
 
+@profiling.timed('rescale_crop')
 def rescale_crop_image(img):
     """Rescale to the standard image size and recrop center """
+    from skimage.transform import rescale
     standard = 256
     scale = standard / min(img.shape[:2])
     img = rescale(img, scale, anti_aliasing=True, channel_axis=2)
@@ -515,6 +626,83 @@ def rescale_crop_image(img):
     return img
 
 
+@profiling.timed('rescale_crop_fast')
+def rescale_crop_image_fast(img, standard=256):
+    """uint8 OpenCV version of rescale_crop_image using the same scaled size and center crop window"""
+    h, w = img.shape[:2]
+    scale = standard / min(h, w)
+    height, width = round(h * scale), round(w * scale)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    img = cv2.resize(img, (width, height), interpolation=interpolation)
+    top, left = int(height / 2 - standard / 2), int(width / 2 - standard / 2)
+    return np.ascontiguousarray(img[top:top + standard, left:left + standard])
+
+
+def read_image_header(img_path):
+    """Read (format, height, width) from a JPEG or PNG header, None for other files"""
+    with open(img_path, 'rb') as f:
+        head = f.read(24)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and len(head) == 24:
+            width, height = struct.unpack('>II', head[16:24])
+            return 'png', height, width
+        if head[:2] != b'\xff\xd8':
+            return None
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            while marker[1] == 0xFF:  # padding bytes between markers
+                marker = marker[1:] + f.read(1)
+                if len(marker) < 2:
+                    return None
+            code = marker[1]
+            if code == 0x01 or 0xD0 <= code <= 0xD8:  # standalone markers carry no length
+                continue
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            # SOF0-SOF15 except DHT (C4), JPG (C8) and DAC (CC) hold the frame dimensions
+            if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                frame = f.read(5)
+                if len(frame) < 5:
+                    return None
+                height, width = struct.unpack('>xHH', frame)
+                return 'jpeg', height, width
+            f.seek(struct.unpack('>H', length)[0] - 2, 1)
+
+
+def _imread(img_path, flags=cv2.IMREAD_COLOR):
+    """cv2.imread timing read and decode separately when profiling is enabled"""
+    if not profiling.is_enabled():
+        return cv2.imread(img_path, flags)
+    with profiling.stage('read'):
+        buf = np.fromfile(img_path, dtype=np.uint8)
+    profiling.count('bytes_read', buf.size)
+    profiling.observe('file_bytes', buf.size)
+    with profiling.stage('decode'):
+        img = cv2.imdecode(buf, flags)
+    if img is None:
+        profiling.count('decode_failures')
+    return img
+
+
+def load_img_rgb_reduced(img_path, standard=256):
+    """Load the img as RGB at the smallest JPEG scale keeping the standard size"""
+    header = read_image_header(img_path)
+    flag = cv2.IMREAD_COLOR
+    if header is not None and header[0] == 'jpeg':
+        short_side = min(header[1:])
+        for factor, reduced_flag in [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                     (2, cv2.IMREAD_REDUCED_COLOR_2)]:
+            if short_side >= factor * standard:
+                flag = reduced_flag
+                break
+    img = _imread(img_path, flag)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img
+
+
 def down_sample(df):
     """Drop the size of each class in the dataframe to that of the minority class"""
     label_counts = df.groupby('label_name', as_index=False)['file_name'].count()
@@ -529,24 +717,38 @@ def down_sample(df):
     return samples
 
 
-def draw_class_counts(df, title):
-    """"""
+def draw_class_counts(df, title, ax=None):
+    """Horizontal bar chart of the image count per class, drawn on ax or the current axis"""
+    import seaborn as sns
     count_df = df.groupby('label_name', as_index=False)['file_name'].count().sort_values(by='file_name', ascending=False)
-    ax = sns.barplot(data=count_df, x='file_name', y='label_name', color='gray')
+    ax = sns.barplot(data=count_df, x='file_name', y='label_name', color='gray', ax=ax)
     ax.bar_label(ax.containers[0], fmt='%d')
     ax.set_title(title)
     ax.set_xlabel('Class Count')
     ax.set_ylabel('Class Name')
+    return ax
+
+
+def show_dataset_overview(df, n_samples=5, thumbnails=None):
+    """One figure with the class sample mosaic next to the class counts"""
+    import matplotlib.pyplot as plt
+    fig, (ax_samples, ax_counts) = plt.subplots(ncols=2, figsize=(2 * n_samples + 8, 2 * df['label_name'].nunique()),
+                                                gridspec_kw={'width_ratios': [n_samples, 4]})
+    show_class_samples(df, n_samples, thumbnails=thumbnails, ax=ax_samples)
+    draw_class_counts(df, 'Images per class', ax=ax_counts)
+    fig.tight_layout()
+    return fig
 
 
 def load_img_rgb(img_path, resize_dims=(256, 256)):
     """Load the img with cv2 and convert color scheme to RGB"""
-    img = cv2.imread(img_path)
+    img = _imread(img_path)
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     img = cv2.resize(img, resize_dims)
     return img
 
 
+@profiling.timed('equalize')
 def normalize_rgb_histogram(img):
     """"""
     R, G, B = cv2.split(img)
@@ -555,6 +757,31 @@ def normalize_rgb_histogram(img):
     return img_eq
 
 
+@profiling.timed('equalize_batch')
+def normalize_rgb_histogram_batch(imgs, out=None):
+    """normalize_rgb_histogram over an N x H x W x 3 uint8 batch, writing into out"""
+    if out is None:
+        out = np.empty_like(imgs)
+    for i, img in enumerate(imgs):
+        cv2.merge([cv2.equalizeHist(c) for c in cv2.split(img)], dst=out[i])
+    return out
+
+
+@profiling.timed('grayscale_batch')
+def rgb_to_grayscale_batch(imgs, dtype=np.float32, out=None):
+    """rgb_to_grayscale over an N x H x W x 3 uint8 batch as float32 in [0, 1] or uint8"""
+    n, h, w = imgs.shape[:3]
+    # Stacking the batch into one tall image converts it with a single OpenCV call
+    gray = cv2.cvtColor(np.ascontiguousarray(imgs).reshape(n * h, w, 3), cv2.COLOR_RGB2GRAY).reshape(n, h, w)
+    if np.dtype(dtype) == np.uint8:
+        if out is None:
+            return gray
+        out[...] = gray
+        return out
+    return np.multiply(gray, np.asarray(1 / 255, dtype=dtype), out=out, dtype=dtype)
+
+
+@profiling.timed('grayscale')
 def rgb_to_grayscale(img):
     """Transform the im"""
     img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
@@ -562,4 +789,79 @@ def rgb_to_grayscale(img):
     return img
 
 
+@profiling.timed('preprocess_image')
+def preprocess_image(img_path, equalize=False, fast=False):
+    """Load, rescale and center crop one image to 256x256x3 uint8 RGB, optionally equalized"""
+    if fast:
+        img = rescale_crop_image_fast(load_img_rgb_reduced(img_path))
+    else:
+        from skimage import img_as_ubyte
+        img = _imread(img_path)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img = img_as_ubyte(rescale_crop_image(img))
+    if equalize:
+        img = normalize_rgb_histogram(img)
+    profiling.count('images_processed')
+    return img
+
+
+def _preprocess_chunk(start, img_paths, equalize, fast):
+    """Worker entry point: preprocess a contiguous chunk of the manifest into a single stacked array"""
+    return start, np.stack([preprocess_image(p, equalize=equalize, fast=fast) for p in img_paths])
+
+
+def iter_chunk_results(func, img_paths, *args, n_workers=None, chunk_size=64, chunk_starts=None, max_pending=None):
+    """Yield func(start, chunk_paths, *args) over chunks of img_paths in order from a process pool"""
+    n_workers = n_workers or os.cpu_count()
+    max_pending = max_pending or 2 * n_workers
+    if chunk_starts is None:
+        chunk_starts = range(0, len(img_paths), chunk_size)
+    profile = profiling.is_enabled()
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        pending = deque()
+        for start in chunk_starts:
+            if len(pending) >= max_pending:
+                yield _collect_chunk(pending.popleft())
+            chunk_paths = img_paths[start:start + chunk_size]
+            pending.append(pool.submit(_run_chunk, profile, func, start, chunk_paths, *args))
+        while pending:
+            yield _collect_chunk(pending.popleft())
+
+
+def _run_chunk(profile, func, start, img_paths, *args):
+    """Worker entry point wrapping func, returning the profiling stats of the chunk with its result"""
+    if not profile:
+        return func(start, img_paths, *args), None
+    profiling.enable()
+    profiling.reset()
+    with profiling.stage('chunk'):
+        result = func(start, img_paths, *args)
+    return result, profiling.snapshot()
+
+
+def _collect_chunk(future):
+    """Wait for a chunk and merge the worker's profiling stats into this process"""
+    result, stats = future.result()
+    if stats is not None:
+        profiling.merge(stats)
+    return result
+
+
+def iter_preprocessed_chunks(df, n_workers=None, chunk_size=64, equalize=False, fast=False, chunk_starts=None):
+    """Yield (start_row, images) chunks of the preprocessed dataframe in order"""
+    return iter_chunk_results(_preprocess_chunk, df['img_path'].to_list(), equalize, fast, n_workers=n_workers,
+                              chunk_size=chunk_size, chunk_starts=chunk_starts)
+
 
+def preprocess_dataframe(df, n_workers=None, chunk_size=64, equalize=False, fast=False, out=None, verbose=True):
+    """Preprocess every image in the dataframe in parallel into one N x 256 x 256 x 3 array"""
+    if out is None:
+        out = np.empty((len(df), 256, 256, 3), dtype=np.uint8)
+    t0 = time.perf_counter()
+    for start, imgs in iter_preprocessed_chunks(df, n_workers=n_workers, chunk_size=chunk_size, equalize=equalize,
+                                                  fast=fast):
+        out[start:start + len(imgs)] = imgs
+    elapsed = time.perf_counter() - t0
+    if verbose:
+        print(f"Preprocessed {len(df)} images in {elapsed:.1f}s ({len(df) / max(elapsed, 1e-9):.1f} images/sec)")
+    return out
@@ -0,0 +1,168 @@
+"""Opt-in stage timers and counters, enabled with enable() or PREPROCESSING_PROFILE=1 and merged across workers"""
+import os
+import json
+import math
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+ENV_VAR = 'PREPROCESSING_PROFILE'
+
+_enabled = os.environ.get(ENV_VAR, '') not in ('', '0')
+_timers = {}
+_counters = {}
+_histograms = {}
+
+
+def enable():
+    """Turn instrumentation on in this process and in pool workers started afterwards"""
+    global _enabled
+    _enabled = True
+    os.environ[ENV_VAR] = '1'
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    os.environ.pop(ENV_VAR, None)
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Drop everything collected so far"""
+    _timers.clear()
+    _counters.clear()
+    _histograms.clear()
+
+
+def _empty_histogram():
+    return {'count': 0, 'total': 0.0, 'min': math.inf, 'max': -math.inf, 'buckets': {}}
+
+
+def _observe(store, name, value):
+    """Add a value to a histogram with power-of-two buckets: bucket k holds values in [2**(k-1), 2**k)"""
+    hist = store.get(name)
+    if hist is None:
+        hist = store[name] = _empty_histogram()
+    hist['count'] += 1
+    hist['total'] += value
+    hist['min'] = min(hist['min'], value)
+    hist['max'] = max(hist['max'], value)
+    bucket = math.frexp(value)[1] if value > 0 else 0
+    hist['buckets'][bucket] = hist['buckets'].get(bucket, 0) + 1
+
+
+def record_time(name, seconds):
+    """Add one timed call of a stage"""
+    if _enabled:
+        _observe(_timers, name, seconds)
+
+
+def count(name, n=1):
+    """Increment a counter such as images processed or bytes read"""
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def observe(name, value):
+    """Add a value (e.g. a file size) to a named histogram"""
+    if _enabled:
+        _observe(_histograms, name, value)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as one call of the named stage"""
+    if not _enabled:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe(_timers, name, time.perf_counter() - t0)
+
+
+def timed(name):
+    """Decorator timing every call of the function as the named stage"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _observe(_timers, name, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+
+def _copy_store(store):
+    return {name: dict(hist, buckets=dict(hist['buckets'])) for name, hist in store.items()}
+
+
+def snapshot():
+    """Plain, picklable copy of everything collected so far"""
+    return {'timers': _copy_store(_timers), 'counters': dict(_counters), 'histograms': _copy_store(_histograms)}
+
+
+def merge(stats):
+    """Add a snapshot, e.g. one returned by a pool worker, into this process's totals"""
+    for store, other in ((_timers, stats['timers']), (_histograms, stats['histograms'])):
+        for name, hist in other.items():
+            mine = store.setdefault(name, _empty_histogram())
+            mine['count'] += hist['count']
+            mine['total'] += hist['total']
+            mine['min'] = min(mine['min'], hist['min'])
+            mine['max'] = max(mine['max'], hist['max'])
+            for bucket, n in hist['buckets'].items():
+                mine['buckets'][bucket] = mine['buckets'].get(bucket, 0) + n
+    for name, n in stats['counters'].items():
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def _percentile(hist, q):
+    """Approximate percentile: the upper bound of the bucket holding the q-th value, capped by the observed max"""
+    target = q / 100 * hist['count']
+    seen = 0
+    for bucket in sorted(hist['buckets']):
+        seen += hist['buckets'][bucket]
+        if seen >= target:
+            return min(math.ldexp(1, bucket), hist['max'])
+    return hist['max']
+
+
+def summary_dict():
+    """Summary of the collected stats as JSON-serializable dicts, slowest stages first"""
+    timers = [{'stage': name, 'calls': t['count'], 'total_s': t['total'], 'mean_ms': 1000 * t['total'] / t['count'],
+               'p50_ms': 1000 * _percentile(t, 50), 'p99_ms': 1000 * _percentile(t, 99), 'max_ms': 1000 * t['max']}
+              for name, t in sorted(_timers.items(), key=lambda item: -item[1]['total'])]
+    histograms = {name: {'count': h['count'], 'mean': h['total'] / h['count'], 'min': h['min'], 'max': h['max'],
+                         'p50': _percentile(h, 50), 'p99': _percentile(h, 99)} for name, h in _histograms.items()}
+    return {'timers': timers, 'counters': dict(_counters), 'histograms': histograms}
+
+
+def summary():
+    """Human readable table of the collected stats"""
+    stats = summary_dict()
+    lines = [f"{'stage':<24}{'calls':>9}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}"]
+    for t in stats['timers']:
+        lines.append(f"{t['stage']:<24}{t['calls']:>9}{t['total_s']:>10.2f}{t['mean_ms']:>10.3f}"
+                     f"{t['p50_ms']:>10.3f}{t['p99_ms']:>10.3f}")
+    for name, n in sorted(stats['counters'].items()):
+        lines.append(f"{name:<24}{n:>9}")
+    for name, h in sorted(stats['histograms'].items()):
+        lines.append(f"{name:<24}{h['count']:>9}  mean {h['mean']:.1f}  p50 {h['p50']:.1f}  p99 {h['p99']:.1f}"
+                     f"  max {h['max']:.1f}")
+    return '\n'.join(lines)
+
+
+def export_json(path):
+    """Write summary_dict() to a JSON file"""
+    with open(path, 'w') as f:
+        json.dump(summary_dict(), f, indent=2)
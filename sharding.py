@@ -0,0 +1,125 @@
+import argparse
+import hashlib
+import json
+import numpy as np
+from preprocessing import FEATURE_PATH, load_manifest
+from features import (extract_hog_features, extract_resnet_embeddings, manifest_hash, open_feature_store,
+                      save_progress, load_features, load_quarantine, save_quarantine, _feature_files)
+
+SHARD_SEED = 12345
+
+
+def shard_keys(df):
+    """Machine independent '<label_name>/<file_name>' key of every row"""
+    return (df['label_name'] + '/' + df['file_name']).to_numpy()
+
+
+def canonical_order(df):
+    """Return the dataframe sorted by its shard key with a fresh index"""
+    order = np.argsort(shard_keys(df), kind='stable')
+    return df.iloc[order].reset_index(drop=True)
+
+
+def assign_shards(df, n_shards, seed=SHARD_SEED):
+    """Deterministic class-stratified shard of every row"""
+    keys = shard_keys(df)
+    hashes = np.array([int(hashlib.md5(f'{seed}:{k}'.encode()).hexdigest()[:16], 16) for k in keys], dtype=np.uint64)
+    labels = df['label_name'].to_numpy()
+    order = np.lexsort((keys, hashes, labels))
+    shards = np.empty(len(df), dtype=np.int64)
+    shards[order] = np.arange(len(df)) % n_shards
+    return shards
+
+
+def shard_frame(df, shard, n_shards, seed=SHARD_SEED):
+    """Rows of one shard in canonical order, with their row position in df in the 'global_row' column"""
+    positions = np.argsort(shard_keys(df), kind='stable')
+    rows = positions[assign_shards(df.iloc[positions], n_shards, seed) == shard]
+    return df.iloc[rows].assign(global_row=rows).reset_index(drop=True)
+
+
+def shard_name(name, shard, n_shards):
+    """Feature store name of one shard's output, e.g. hog.shard-003-of-008"""
+    return f'{name}.shard-{shard:03d}-of-{n_shards:03d}'
+
+
+def run_shard(df, shard, n_shards, extract=extract_hog_features, name='hog', seed=SHARD_SEED, **kwargs):
+    """Run a feature extraction on the rows of one shard into its own store"""
+    return extract(shard_frame(df, shard, n_shards, seed), name=shard_name(name, shard, n_shards), **kwargs)
+
+
+def merge_shards(df, n_shards, name='hog', seed=SHARD_SEED, verbose=True):
+    """Merge the per-shard stores into one store aligned with the rows of df"""
+    # Position in df of every row of the canonical order the shards were assigned in
+    positions = np.argsort(shard_keys(df), kind='stable')
+    canonical = df.iloc[positions]
+    assignment = assign_shards(canonical, n_shards, seed)
+    shards, problems, params = [], [], None
+    for shard in range(n_shards):
+        rows = np.flatnonzero(assignment == shard)
+        try:
+            data, meta = load_features(shard_name(name, shard, n_shards))
+        except FileNotFoundError:
+            problems.append(f'{shard} (missing)')
+            continue
+        except ValueError:
+            problems.append(f'{shard} (incomplete)')
+            continue
+        if meta['manifest'] != manifest_hash(canonical.iloc[rows]) or meta['n_rows'] != len(rows):
+            problems.append(f'{shard} (computed on other rows)')
+            continue
+        shard_params = {k: v for k, v in meta.items() if k not in ('manifest', 'n_rows', 'quarantined')}
+        if params is None:
+            params = shard_params
+        elif shard_params != params:
+            problems.append(f'{shard} (other parameters)')
+            continue
+        shards.append((shard, rows, data))
+    if problems:
+        raise ValueError(f"Cannot merge {name}: shards {', '.join(problems)} of {n_shards}")
+
+    # Exactly the metadata of a single-node extraction on df, so that extraction resumes the merged store
+    meta = {k: v for k, v in params.items() if k not in ('n_dims', 'dtype')}
+    meta['manifest'] = manifest_hash(df)
+    fingerprints = np.zeros(len(df), dtype=np.uint64)
+    for shard, rows, _ in shards:
+        fingerprints[positions[rows]] = np.load(_feature_files(shard_name(name, shard, n_shards))[3])
+    out, done = open_feature_store(name, meta, len(df), params['n_dims'], params['dtype'], fingerprints=fingerprints)
+    quarantine = {}
+    for shard, rows, data in shards:
+        rows = positions[rows]
+        out[rows] = data
+        done[rows] = True
+        quarantine.update({int(rows[row]): entry
+                           for row, entry in load_quarantine(shard_name(name, shard, n_shards)).items()})
+    out.flush()
+    save_quarantine(name, quarantine)
+    save_progress(name, done)
+    with open(f'{FEATURE_PATH}/{name}_shards.json', 'w') as f:
+        json.dump({'n_shards': n_shards, 'shard_seed': seed}, f)
+    if verbose:
+        print(f"Merged {n_shards} shards of {name} into a {len(df)} x {params['n_dims']} matrix")
+    del out
+    return load_features(name, df)[0]
+
+
+def main():
+    extractors = {'hog': extract_hog_features, 'resnet101': extract_resnet_embeddings}
+    parser = argparse.ArgumentParser(description='Run one shard of a feature extraction, or merge all shards')
+    parser.add_argument('feature', choices=list(extractors))
+    parser.add_argument('--n-shards', type=int, required=True)
+    parser.add_argument('--shard', type=int, help='shard to extract on this node')
+    parser.add_argument('--merge', action='store_true', help='merge the finished shards')
+    parser.add_argument('--n-workers', type=int)
+    args = parser.parse_args()
+
+    df = load_manifest()
+    if args.shard is not None:
+        run_shard(df, args.shard, args.n_shards, extractors[args.feature], name=args.feature,
+                  n_workers=args.n_workers)
+    if args.merge:
+        merge_shards(df, args.n_shards, name=args.feature)
+
+
+if __name__ == '__main__':
+    main()
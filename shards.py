@@ -0,0 +1,105 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import cv2
+from preprocessing import FEATURE_PATH
+from image_cache import file_stats
+
+SHARD_PATH = f'{FEATURE_PATH}/shards'
+
+
+def _shard_files(name):
+    """Return the shard file name pattern and the index file name of a named shard set"""
+    return f'{SHARD_PATH}/{name}-{{:05d}}.bin', f'{SHARD_PATH}/{name}_index.parquet'
+
+
+def pack_shards(df, name='raw', shard_size_mb=1024, verbose=True):
+    """Append the encoded bytes of new or changed images to shard files and return the index"""
+    pattern, index_file = _shard_files(name)
+    todo = file_stats(df)
+    index = None
+    if os.path.exists(index_file):
+        index = pd.read_parquet(index_file)
+        fresh = todo.merge(index[['img_path', 'size', 'mtime_ns']], how='left', indicator=True)['_merge'] == 'both'
+        todo = todo[~fresh.to_numpy()]
+        if todo.empty:
+            return index
+
+    t0 = time.perf_counter()
+    os.makedirs(SHARD_PATH, exist_ok=True)
+    shard = int(index['shard'].max()) if index is not None else 0
+    shard_limit = shard_size_mb * 1024 * 1024
+    entries = []
+    out = open(pattern.format(shard), 'ab')
+    try:
+        for img_path, size, mtime_ns in zip(todo['img_path'], todo['size'], todo['mtime_ns']):
+            if out.tell() and out.tell() + size > shard_limit:
+                out.close()
+                shard += 1
+                out = open(pattern.format(shard), 'ab')
+            with open(img_path, 'rb') as f:
+                data = f.read()
+            entries.append((img_path, shard, out.tell(), len(data), size, mtime_ns))
+            out.write(data)
+        out.flush()
+        os.fsync(out.fileno())
+    finally:
+        out.close()
+
+    # The index is only rewritten once the shard bytes are on disk, so an interrupted pack leaves unindexed bytes at
+    # the end of a shard and never an index entry pointing at missing data
+    new_index = pd.DataFrame(entries, columns=['img_path', 'shard', 'offset', 'length', 'size', 'mtime_ns'])
+    new_index = new_index.astype({c: np.int64 for c in new_index.columns[1:]})
+    if index is not None:
+        new_index = pd.concat([index[~index['img_path'].isin(new_index['img_path'])], new_index], ignore_index=True)
+    index = new_index
+    index.to_parquet(index_file + '.tmp', index=False)
+    os.replace(index_file + '.tmp', index_file)
+    if verbose:
+        n_bytes = sum(entry[3] for entry in entries)
+        elapsed = time.perf_counter() - t0
+        print(f"Packed {len(entries)} images ({n_bytes / 2 ** 20:.1f} MB) into {shard + 1} shards in {elapsed:.1f}s")
+    return index
+
+
+class ShardReader:
+    """Read and decode images from memory-mapped shard files"""
+
+    def __init__(self, name='raw'):
+        self.name = name
+        self.pattern, index_file = _shard_files(name)
+        index = pd.read_parquet(index_file)
+        self.locations = dict(zip(index['img_path'], zip(index['shard'], index['offset'], index['length'])))
+        self._shards = {}
+
+    def _shard(self, shard):
+        """Memory map of one shard file, opened on first use in each process"""
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(self.pattern.format(shard), dtype=np.uint8, mode='r')
+        return self._shards[shard]
+
+    def __contains__(self, img_path):
+        return img_path in self.locations
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily in worker processes instead of being pickled
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def read_bytes(self, img_path):
+        """Encoded bytes of the image as a zero-copy view into the shard memory map"""
+        shard, offset, length = self.locations[img_path]
+        return self._shard(shard)[offset:offset + length]
+
+    def imread(self, img_path, flags=cv2.IMREAD_COLOR):
+        """Drop-in replacement for cv2.imread(img_path, flags) decoding from the shard buffer"""
+        return cv2.imdecode(self.read_bytes(img_path), flags)
+
+    def load_img_rgb(self, img_path, resize_dims=(256, 256)):
+        """Shard backed equivalent of preprocessing.load_img_rgb"""
+        img = self.imread(img_path)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img = cv2.resize(img, resize_dims)
+        return img
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+from preprocessing import FEATURE_PATH, load_img_rgb_reduced, rescale_crop_image_fast
+from image_cache import load_row_cache, gather_rows
+
+THUMBNAIL_PATH = f'{FEATURE_PATH}/thumbnails'
+THUMBNAIL_SIZE = 64
+
+
+def _thumbnail_chunk(start, img_paths, size):
+    """Worker entry point: center-cropped thumbnails of a chunk of images, black if unreadable"""
+    thumbs = np.zeros((len(img_paths), size, size, 3), dtype=np.uint8)
+    for i, img_path in enumerate(img_paths):
+        try:
+            thumbs[i] = rescale_crop_image_fast(load_img_rgb_reduced(img_path, standard=size), standard=size)
+        except Exception:
+            pass
+    return start, thumbs
+
+
+def load_thumbnail_store(df, size=THUMBNAIL_SIZE, n_workers=None, chunk_size=256, verbose=True):
+    """Path-keyed thumbnail store of the manifest images and the store row of every df row"""
+    return load_row_cache(df, THUMBNAIL_PATH, 'thumbnails', {'size': size}, (size, size, 3), _thumbnail_chunk, size,
+                          n_workers=n_workers, chunk_size=chunk_size, label='Thumbnails', verbose=verbose)
+
+
+def load_thumbnails(df, size=THUMBNAIL_SIZE, n_workers=None, chunk_size=256, verbose=True):
+    """N x size x size x 3 uint8 thumbnails aligned with the dataframe rows, gathered from the thumbnail store"""
+    return gather_rows(*load_thumbnail_store(df, size, n_workers, chunk_size, verbose))
+
+
+def sample_rows(df, n_samples=5, column='label_name'):
+    """{class: row positions of n_samples random images} as drawn by df.sample(random_state=12345)"""
+    values = df[column].to_numpy()
+    samples = {}
+    for label in df[column].unique():
+        rows = pd.Series(np.flatnonzero(values == label))
+        samples[label] = rows.sample(min(n_samples, len(rows)), random_state=12345).to_numpy()
+    return samples
+
+
+def class_mosaic(thumbnails, samples, n_samples=None):
+    """Compose the thumbnails of {class: rows} samples into one image, one row of tiles per class"""
+    n_samples = n_samples or max(len(rows) for rows in samples.values())
+    size = thumbnails.shape[1]
+    tiles = np.zeros((len(samples), n_samples, size, size, 3), dtype=np.uint8)
+    for i, rows in enumerate(samples.values()):
+        # Sorted rows turn the memory-map gather into a forward scan
+        order = np.argsort(rows)
+        tiles[i, order] = thumbnails[rows[order]]
+    return tiles.transpose(0, 2, 1, 3, 4).reshape(len(samples) * size, n_samples * size, 3)